@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# Compare two result files of benchmarks.suite. A benchmark whose median
+# grew by more than the threshold, or that runs more queries, is a
+# regression and makes the exit status 1.
+#
+# python -m benchmarks.compare before.json after.json --threshold=0.1
+
+import json
+import sys
+from optparse import OptionParser
+
+
+def compare(before, after, threshold):
+    ''' Yield (name, before median, after median, ratio, before queries,
+        after queries, regressed) for the benchmarks in both results.'''
+    for name in sorted(set(before['benchmarks']) & set(after['benchmarks'])):
+        old = before['benchmarks'][name]
+        new = after['benchmarks'][name]
+        ratio = new['median'] / old['median'] if old['median'] else float('inf')
+        regressed = ratio > 1 + threshold or new['queries'] > old['queries']
+        yield name, old['median'], new['median'], ratio, old['queries'], new['queries'], regressed
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] before.json after.json')
+    parser.add_option('--threshold', default=0.1, type='float', dest='threshold',
+                      help='allowed growth of the median, 0.1 is 10%')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('expected two result files')
+    with open(args[0]) as f:
+        before = json.load(f)
+    with open(args[1]) as f:
+        after = json.load(f)
+    if before['dataset'] != after['dataset']:
+        print('The datasets differ, the results are not comparable', file=sys.stderr)
+    print('%s..%s' % ((before['commit'] or '?')[:10], (after['commit'] or '?')[:10]))
+    regressions = 0
+    for name, old, new, ratio, old_queries, new_queries, regressed in compare(before, after, options.threshold):
+        regressions += regressed
+        print('%-20s %10.4fs %10.4fs %6.2fx %6d %6d%s' % (
+            name, old, new, ratio, old_queries, new_queries, '  REGRESSION' if regressed else ''))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
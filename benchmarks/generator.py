@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Generate a CMDB in the format of examples/example-data.json, which the
+# bulk import and scripts/json_import.py accept. The same seed and options
+# always give the same document.
+#
+# Items pick one of a fixed number of tag sets, the first ones far more
+# often than the rest. Tags and items define variables from a shared pool
+# of keys, so items override tags and tags override each other. Some items
+# have children further down the list, so there are no cycles.
+#
+# python -m benchmarks.generator --items=10000 --tags=200 > data.json
+
+import json
+import random
+import sys
+from optparse import OptionParser
+
+TAG_KINDS = ['dc', 'env', 'role', 'team', 'application-cluster']
+
+
+def add_options(parser):
+    parser.add_option('--items', default=1000, type='int', dest='items')
+    parser.add_option('--tags', default=100, type='int', dest='tags')
+    parser.add_option('--tag-sets', default=50, type='int', dest='tag_sets',
+                      help='distinct combinations of tags the items have')
+    parser.add_option('--tags-per-item', default=4, type='int', dest='tags_per_item')
+    parser.add_option('--tag-set-skew', default=1.0, type='float', dest='tag_set_skew',
+                      help='zipf exponent of how often each tag set is used, 0 for uniform')
+    parser.add_option('--variable-keys', default=200, type='int', dest='variable_keys',
+                      help='keys shared by all tags and items')
+    parser.add_option('--tag-variables', default=20, type='int', dest='tag_variables')
+    parser.add_option('--item-variables', default=5, type='int', dest='item_variables')
+    parser.add_option('--value-size', default=20, type='int', dest='value_size',
+                      help='characters in a string value')
+    parser.add_option('--nested-values', default=0.2, type='float', dest='nested_values',
+                      help='fraction of values that are lists or objects')
+    parser.add_option('--parents', default=0.05, type='float', dest='parents',
+                      help='fraction of items with children')
+    parser.add_option('--children-per-parent', default=5, type='int', dest='children_per_parent')
+    parser.add_option('--seed', default=0, type='int', dest='seed')
+
+
+def generate_value(rng, options):
+    text = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for i in range(options.value_size))
+    if rng.random() >= options.nested_values:
+        return text
+    if rng.random() < 0.5:
+        return [text[:options.value_size // 2], text[options.value_size // 2:], '%d.%d.%d.%d' % (
+            10, rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))]
+    return {'name': text, 'port': rng.randint(1024, 65535), 'enabled': rng.random() < 0.5}
+
+
+def generate_variables(rng, options, count):
+    keys = rng.sample(range(options.variable_keys), min(count, options.variable_keys))
+    return dict(('var_%d' % (key), generate_value(rng, options)) for key in keys)
+
+
+def generate(options):
+    ''' Return a {"tags": [...], "items": [...]} document. '''
+    rng = random.Random(options.seed)
+    ### names of different lengths, longer names win on duplicate keys
+    tag_names = ['%s-%d' % (TAG_KINDS[i % len(TAG_KINDS)], i) for i in range(options.tags)]
+    tags = [{'name': name, 'vars': generate_variables(rng, options, options.tag_variables)}
+            for name in tag_names]
+
+    tag_sets = [sorted(rng.sample(tag_names, min(options.tags_per_item, len(tag_names))))
+                for i in range(options.tag_sets)]
+    weights = [1.0 / (rank + 1) ** options.tag_set_skew for rank in range(len(tag_sets))]
+    item_names = ['host-%06d' % (i) for i in range(options.items)]
+    items = []
+    for i, name in enumerate(item_names):
+        item = {
+            'name': name,
+            'tags': [{'name': tag_name} for tag_name in rng.choices(tag_sets, weights)[0]] if tag_sets else [],
+            'vars': generate_variables(rng, options, options.item_variables),
+        }
+        later = item_names[i+1:]
+        if later and rng.random() < options.parents:
+            children = rng.sample(later, min(options.children_per_parent, len(later)))
+            item['children'] = [{'name': child} for child in sorted(children)]
+        items.append(item)
+    return {'tags': tags, 'items': items}
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    add_options(parser)
+    options, args = parser.parse_args()
+    json.dump(generate(options), sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
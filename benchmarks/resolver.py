@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Compare resolving the variables of every host with and without sharing
+# the merged tag layers between hosts with the same tags.
+#
+# python -m benchmarks.resolver --hosts=5000 --tag-sets=20
+
+import os
+import random
+import time
+from optparse import OptionParser
+
+os.environ.setdefault('MELANGE_CONFIG_MODULE', 'melange.config.TestingConfig')
+
+from melange import Item, Tag
+from melange.models import VariableResolver
+
+parser = OptionParser()
+parser.add_option('--hosts', default=5000, type='int', dest='hosts')
+parser.add_option('--tags', default=40, type='int', dest='tags')
+parser.add_option('--tag-sets', default=20, type='int', dest='tag_sets')
+parser.add_option('--tags-per-host', default=5, type='int', dest='tags_per_host')
+parser.add_option('--variables', default=50, type='int', dest='variables')
+parser.add_option('--seed', default=0, type='int', dest='seed')
+options, args = parser.parse_args()
+
+
+def create_fleet():
+    rng = random.Random(options.seed)
+    tags = []
+    for i in range(options.tags):
+        tag = Tag('tag-%s' % ('x' * rng.randint(0, 10)) + str(i))
+        for j in range(options.variables):
+            tag.set_variable('var-%d' % (rng.randint(0, options.variables * 2)), 'value-%d' % (i))
+        tags.append(tag)
+    tag_sets = [rng.sample(tags, options.tags_per_host) for i in range(options.tag_sets)]
+    items = []
+    for i in range(options.hosts):
+        item = Item('host-%d' % (i))
+        for tag in rng.choice(tag_sets):
+            item.tags.append(tag)
+        item.set_variable('ip', '10.0.%d.%d' % (i // 256, i % 256))
+        items.append(item)
+    return items
+
+
+def measure(name, f):
+    start = time.perf_counter()
+    result = f()
+    print('%-10s %8.3fs' % (name, time.perf_counter() - start))
+    return result
+
+
+items = create_fleet()
+unshared = measure('unshared', lambda: [item.get_all_variables() for item in items])
+resolver = VariableResolver()
+shared = measure('shared', lambda: [item.get_all_variables(resolver) for item in items])
+assert shared == unshared
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# Time the main code paths on a generated CMDB and write the results as
+# JSON, to compare them between commits with benchmarks.compare.
+#
+# The document of benchmarks.generator is imported through /api/bulk/ and
+# log entries are added. The API benchmarks use the Flask test client.
+# Every benchmark runs --repeat times and records the duration of every
+# run and the number of queries of the last one.
+#
+# The in-memory SQLite database of the testing config is used, set
+# MELANGE_CONFIG_MODULE to benchmark another database. It is emptied.
+#
+# python -m benchmarks.suite --items=5000 --tags=200 --output=results.json
+# python -m benchmarks.suite --only=to_data,update_from --repeat=10
+
+import base64
+import collections
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+os.environ.setdefault('MELANGE_CONFIG_MODULE', 'melange.config.TestingConfig')
+
+from importlib.metadata import version
+
+from sqlalchemy import event
+
+import melange
+from melange import Item, Log, User, app, db_session
+from melange.database import engine
+from melange.models import CHUNK_SIZE, VariableResolver
+
+from benchmarks.generator import add_options, generate
+
+USER = 'benchmark'
+PASSWORD = 'benchmark'
+AUTH_HEADERS = {'Authorization': 'Basic %s' % (base64.b64encode(('%s:%s' % (USER, PASSWORD)).encode()).decode())}
+
+
+class QueryCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(engine, 'before_cursor_execute', self.count_query)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(engine, 'before_cursor_execute', self.count_query)
+
+    def count_query(self, *args):
+        self.count += 1
+
+
+def measure(run, repeat, setup=None):
+    ''' Call setup, which is not timed, and run repeat times. '''
+    durations = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            run()
+            durations.append(time.perf_counter() - start)
+    return {
+        'runs': durations,
+        'min': min(durations),
+        'median': statistics.median(durations),
+        'mean': statistics.mean(durations),
+        'queries': counter.count,
+    }
+
+
+def reset_database():
+    db_session.remove()
+    melange.database.drop_db()
+    melange.database.init_db()
+    user = User(USER)
+    user.password = PASSWORD
+    user.save()
+    db_session.remove()
+
+
+def add_log_entries(document, count, days, rng):
+    ''' Add count entries about the items and tags over the last days. '''
+    names = [entry['name'] for entry in document['items'] + document['tags']]
+    now = datetime.utcnow()
+    rows = []
+    for i in range(count):
+        rows.append({
+            'name': rng.choice(names),
+            'date': now - timedelta(seconds=rng.randint(0, days * 86400)),
+            'message': 'Variables changed: var_%d' % (rng.randint(0, 100)),
+            'changes': None,
+        })
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db_session.execute(Log.__table__.insert(), rows[start:start+CHUNK_SIZE])
+    db_session.commit()
+    db_session.remove()
+
+
+def get(client, url):
+    response = client.get(url, headers=AUTH_HEADERS)
+    assert response.status_code == 200, (url, response.status_code)
+    ### streamed responses are generated while they are read
+    response.get_data()
+    return response
+
+
+class Suite(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.rng = random.Random(options.seed)
+        self.document = generate(options)
+        self.body = json.dumps(self.document)
+        self.client = app.test_client()
+        self.sample = sorted(self.rng.sample([item['name'] for item in self.document['items']],
+                                             min(options.sample, len(self.document['items']))))
+        self.updates = 0
+
+    def benchmarks(self):
+        ''' The benchmarks in the order they run, import fills the database. '''
+        return [
+            ('import', self.bench_import),
+            ('export', self.bench_export),
+            ('ansible_inventory', self.bench_ansible_inventory),
+            ('tag_items', self.bench_tag_items),
+            ('log', self.bench_log),
+            ('reports', self.bench_reports),
+            ('to_data', self.bench_to_data),
+            ('get_all_variables', self.bench_get_all_variables),
+            ('update_from', self.bench_update_from),
+        ]
+
+    def run(self, only=None):
+        results = {}
+        reset_database()
+        self.import_document()
+        self.populate_log()
+        for name, benchmark in self.benchmarks():
+            if only and name not in only:
+                continue
+            results[name] = benchmark()
+            print('%-20s %10.4fs median %10.4fs min %6d queries' % (
+                name, results[name]['median'], results[name]['min'], results[name]['queries']), file=sys.stderr)
+        return results
+
+    def import_document(self):
+        response = self.client.post('/api/bulk/', data=self.body, content_type='application/json',
+                                    headers=AUTH_HEADERS)
+        assert response.status_code == 200, response.get_data(as_text=True)
+        db_session.remove()
+
+    def populate_log(self):
+        add_log_entries(self.document, self.options.log_entries, self.options.log_days,
+                        random.Random(self.options.seed))
+
+    def bench_import(self):
+        result = measure(self.import_document, self.options.repeat, reset_database)
+        self.populate_log()
+        return result
+
+    def bench_export(self):
+        return measure(lambda: get(self.client, '/api/export/'), self.options.repeat)
+
+    def bench_ansible_inventory(self):
+        return measure(lambda: get(self.client, '/api/ansible_inventory/'), self.options.repeat)
+
+    def bench_tag_items(self):
+        return measure(lambda: get(self.client, '/api/tag_items/'), self.options.repeat)
+
+    def bench_log(self):
+        def run():
+            get(self.client, '/api/log/?limit=100')
+            get(self.client, '/api/item/%s/history/' % (self.sample[0]))
+        return measure(run, self.options.repeat)
+
+    def bench_reports(self):
+        ''' Check a variable of the most used tag set. '''
+        tag_sets = collections.Counter(tuple(tag['name'] for tag in item['tags']) for item in self.document['items'])
+        tag_names = list(tag_sets.most_common(1)[0][0])
+        tags = dict((tag['name'], tag) for tag in self.document['tags'])
+        keys = sorted(set(key for name in tag_names for key in tags[name]['vars'])) or ['var_0']
+        url = '/reports/?check-tags=%s&check-variable=%s' % (','.join(tag_names), keys[0])
+        with self.client.session_transaction() as session:
+            session['username'] = USER
+        try:
+            return measure(lambda: get(self.client, url), self.options.repeat)
+        finally:
+            with self.client.session_transaction() as session:
+                session.pop('username', None)
+
+    def bench_to_data(self):
+        def run():
+            for item in Item.find_by_names(self.sample).values():
+                item.to_data()
+        return measure(run, self.options.repeat, db_session.remove)
+
+    def bench_get_all_variables(self):
+        def run():
+            resolver = VariableResolver()
+            for item in Item.find_by_names(self.sample).values():
+                item.get_all_variables(resolver)
+        return measure(run, self.options.repeat, db_session.remove)
+
+    def bench_update_from(self):
+        ''' Change a variable of every sampled item, one commit per item
+            like a PUT.'''
+        changes = []
+
+        def setup():
+            db_session.remove()
+            self.updates += 1
+            changes[:] = []
+            for item in Item.find_by_names(self.sample).values():
+                data = item.to_data()
+                data['vars'] = [var for var in data['vars'] if 'tag' not in var and var['key'] != 'benchmark']
+                data['vars'].append({'key': 'benchmark', 'value': self.updates})
+                changes.append((item, data))
+
+        def run():
+            for item, data in changes:
+                item.update_from(data)
+                item.save()
+        return measure(run, self.options.repeat, setup)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = OptionParser()
+    add_options(parser)
+    parser.add_option('--log-entries', default=10000, type='int', dest='log_entries')
+    parser.add_option('--log-days', default=365, type='int', dest='log_days')
+    parser.add_option('--sample', default=100, type='int', dest='sample',
+                      help='items for to_data, get_all_variables and update_from')
+    parser.add_option('--repeat', default=5, type='int', dest='repeat')
+    parser.add_option('--only', default='', dest='only', help='comma separated benchmarks')
+    parser.add_option('--output', default=None, dest='output', help='JSON file, standard output by default')
+    options, args = parser.parse_args()
+
+    suite = Suite(options)
+    only = [name for name in options.only.split(',') if name]
+    unknown = set(only) - set(name for name, benchmark in suite.benchmarks())
+    if unknown:
+        parser.error('unknown benchmarks: %s' % (', '.join(sorted(unknown))))
+    results = {
+        'commit': git_commit(),
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'sqlalchemy': version('SQLAlchemy'),
+        'flask': version('Flask'),
+        'database': engine.dialect.name,
+        'options': vars(options),
+        'dataset': {
+            'items': len(suite.document['items']),
+            'tags': len(suite.document['tags']),
+            'variables': sum(len(entry['vars']) for entry in suite.document['items'] + suite.document['tags']),
+            'children': sum(len(item.get('children', [])) for item in suite.document['items']),
+            'log_entries': options.log_entries,
+        },
+        'benchmarks': suite.run(only),
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
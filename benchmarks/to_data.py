@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Compare the vars section of Item.to_data with the merge it replaced,
+# which removed overridden variables from a list, for hosts with many
+# overlapping tag variables.
+#
+# python -m benchmarks.to_data --hosts=200 --variables=500
+
+import os
+import random
+import time
+from optparse import OptionParser
+
+os.environ.setdefault('MELANGE_CONFIG_MODULE', 'melange.config.TestingConfig')
+
+from melange import Item, Tag
+from melange.models import tag_length
+
+parser = OptionParser()
+parser.add_option('--hosts', default=200, type='int', dest='hosts')
+parser.add_option('--tags-per-host', default=5, type='int', dest='tags_per_host')
+parser.add_option('--variables', default=500, type='int', dest='variables')
+parser.add_option('--own-variables', default=50, type='int', dest='own_variables')
+parser.add_option('--seed', default=0, type='int', dest='seed')
+options, args = parser.parse_args()
+
+
+def create_fleet():
+    ''' Every tag defines most of the same keys, so they override each other. '''
+    rng = random.Random(options.seed)
+    tags = []
+    for i in range(options.tags_per_host * 2):
+        tag = Tag('tag-%s' % ('x' * rng.randint(0, 10)) + str(i))
+        for j in rng.sample(range(options.variables), options.variables * 9 // 10):
+            tag.set_variable('var-%d' % (j), 'value-%d' % (i))
+        tags.append(tag)
+    items = []
+    for i in range(options.hosts):
+        item = Item('host-%d' % (i))
+        for tag in rng.sample(tags, options.tags_per_host):
+            item.tags.append(tag)
+        for j in rng.sample(range(options.variables), options.own_variables):
+            item.set_variable('var-%d' % (j), 'host-%d' % (i))
+        items.append(item)
+    return items
+
+
+def tag_href(tag):
+    return '/api/tag/%s/' % (tag.name)
+
+
+def quadratic_vars(item):
+    vars = []
+    var_keys = {}
+    for tag in sorted(item.tags, key=tag_length):
+        for k, v in tag.variables.items():
+            var = {'key': k, 'value': v, 'tag': tag.name, 'href': tag_href(tag)}
+            if k in var_keys:
+                vars.remove(var_keys[k])
+            var_keys[k] = var
+            vars.append(var)
+    for k, v in item.variables.items():
+        if k in var_keys:
+            vars.remove(var_keys[k])
+        vars.append({'key': k, 'value': v})
+    return sorted(vars, key=lambda var: var['key'])
+
+
+def measure(name, f):
+    start = time.perf_counter()
+    result = f()
+    print('%-10s %8.3fs' % (name, time.perf_counter() - start))
+    return result
+
+
+items = create_fleet()
+quadratic = measure('quadratic', lambda: [quadratic_vars(item) for item in items])
+linear = measure('linear', lambda: [item.to_data(tag_href=tag_href)['vars'] for item in items])
+assert linear == quadratic
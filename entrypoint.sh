@@ -14,6 +14,9 @@ if db_url is not None:
     if url.scheme == 'sqlite':
         if os.path.exists(url.path):
             print(f'Database {url.path} already exists')
+            from melange.database import upgrade_db
+            print('Upgrading database')
+            upgrade_db()
             sys.exit(0)
         print(f'Will initialize database at {url.path}')
     else:
@@ -29,6 +32,12 @@ admin.password = 'admin'
 admin.save()
 INITDB
 
+### metrics of an earlier run would be added to the new ones
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
 export SECRET_KEY=$(python -c 'import os; print(os.urandom(16))')
 
 exec "$@"
@@ -18,7 +18,7 @@
 import importlib
 import os
 
-from flask import Flask
+from flask import Flask, request
 
 
 class MelangeException(Exception):
@@ -36,8 +36,11 @@ elif 'MELANGE_CONFIG_ENVIRON' in os.environ:
 else:
     app.config.from_object('melange.config.DevelopmentConfig')
 
-from melange.database import db_session
-from melange.models import Item, Tag, User, Log
+from melange.database import db_session, use_replica
+from melange.instrumentation import (InstrumentedRequest, add_server_timing, log_request_stats,
+                                     start_request_stats)
+app.request_class = InstrumentedRequest
+from melange.models import Item, Tag, User, Token, Log, forget_changes
 
 import melange.filters
 import melange.views
@@ -51,6 +54,30 @@ app.register_blueprint(melange_api, url_prefix='/api')
 from melange.reports import reports
 app.register_blueprint(reports, url_prefix='/reports')
 
+if app.config['METRICS']:
+    import melange.metrics
+if app.config['PROFILING']:
+    import melange.profiling
+
+@app.before_request
+def start_instrumentation():
+    start_request_stats()
+
+@app.before_request
+def choose_database():
+    ### the user pages write while logging in
+    if request.method in ['GET', 'HEAD', 'OPTIONS'] and request.blueprint != 'user_auth':
+        use_replica()
+
+@app.after_request
+def server_timing(response):
+    return add_server_timing(response)
+
 @app.teardown_request
 def shutdown_session(exception=None):
     db_session.close()
+    ### changes of objects that were never flushed do not end a transaction
+    forget_changes(db_session)
+    db_session.info.pop('replica', None)
+    db_session.info.pop('wrote', None)
+    log_request_stats(exception)
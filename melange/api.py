@@ -16,14 +16,27 @@
 # along with Melange.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import os
+
+from datetime import datetime, timezone
+from functools import wraps
 
 from flask import Blueprint, abort, redirect, request, url_for, make_response
 
-from melange import Item, Tag, MelangeException
+from melange import Item, Log, Tag, MelangeException, app
 from melange.auth import basic_auth, session_auth_test
+from melange.bulk import import_data
+from melange.cache import credential_cache
+from melange.database import begin_snapshot, pool_stats, retry_on_lock
+from melange.inventory import Inventory, find_item_names, iter_tag_items
+from melange.models import LOG_PAGE_SIZE, get_revision
+from melange.retention import iter_archived_log
+from melange.streaming import JSONList, JSONObject, stream_json
 
 melange_api = Blueprint('melange_api', __name__)
 
+MAX_LOG_PAGE_SIZE = 1000
+
 
 def json_response(data):
     response = make_response(json.dumps(data), 200)
@@ -31,14 +44,47 @@ def json_response(data):
     return response
 
 
+def conditional(f):
+    ''' Tag GET responses with the data revision and answer 304 Not
+        Modified when the client already has that revision.
+        The revision is read before any data, so it is never newer.'''
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if request.method != 'GET':
+            return f(*args, **kwargs)
+        etag = 'rev-%d' % (get_revision())
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            response = f(*args, **kwargs)
+        if response.status_code in (200, 304):
+            response.set_etag(etag, weak=True)
+        return response
+    return decorated
+
+
 @melange_api.route('/', methods=['GET'])
 def start():
     return redirect(url_for('melange_api.list_tags'))
 
 
+@melange_api.route('/stats/', methods=['GET'])
+@session_auth_test
+@basic_auth
+def stats():
+    ''' Statistics of the worker process that answers. '''
+    return json_response({
+        'pid': os.getpid(),
+        'pool': pool_stats(),
+        'auth_cache': credential_cache.stats(),
+    })
+
+
 @melange_api.route('/item/<name>/', methods=['GET', 'PUT', 'DELETE'])
 @session_auth_test
 @basic_auth
+@conditional
+@retry_on_lock
 def show_item(name):
     item = Item.find(name)
     if not item:
@@ -75,6 +121,8 @@ def show_item(name):
 @melange_api.route('/tag/', methods=['GET', 'POST'])
 @session_auth_test
 @basic_auth
+@conditional
+@retry_on_lock
 def list_tags():
     if request.method == 'POST':
         if not request.json:
@@ -106,56 +154,177 @@ def list_tags():
 @melange_api.route('/tag_items/', methods=['GET'])
 @session_auth_test
 @basic_auth
+@conditional
 def tag_items():
-    def item_url(item):
-        return url_for('melange_api.show_item', name=item.name)
-    tags = [tag.to_data(item_href=item_url) for tag in Tag.find_all()]
-    for tag in tags:
-        tag['href'] = url_for('melange_api.show_tag', name=tag['name'])
+    def tags():
+        for tag, item_names in iter_tag_items():
+            yield {
+                'name': tag.name,
+                'items': [{'name': name, 'href': url_for('melange_api.show_item', name=name)}
+                          for name in item_names],
+                'vars': tag.variables,
+                'href': url_for('melange_api.show_tag', name=tag.name),
+            }
+    return stream_json(JSONList(tags()))
+
+
+@melange_api.route('/bulk/', methods=['POST'])
+@session_auth_test
+@basic_auth
+@retry_on_lock
+def bulk_import():
+    if not request.json:
+        abort(415)
+    mode = request.args.get('mode', 'overwrite')
+    if mode not in ['overwrite', 'merge']:
+        abort(400)
+    try:
+        summary = import_data(request.json, overwrite=(mode == 'overwrite'))
+    except MelangeException as e:
+        response = make_response(json.dumps({'error': str(e)}), 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    return json_response(summary)
 
-    response = make_response(json.dumps(tags), 200)
-    response.headers['Content-Type'] = 'application/json'
-    return response
 
+@melange_api.route('/export/', methods=['GET'])
+@session_auth_test
+@basic_auth
+@conditional
+def export():
+    ''' The document of scripts/json_export.py, which the bulk import
+        accepts. compact=1 leaves out the hrefs.'''
+    compact = request.args.get('compact', '') not in ['', '0', 'false']
+    begin_snapshot()
+    inventory = Inventory.load()
+
+    def item_url(name):
+        return url_for('melange_api.show_item', name=name)
+
+    def tag_url(name):
+        return url_for('melange_api.show_tag', name=name)
+
+    if compact:
+        items = inventory.export_items()
+    else:
+        items = inventory.export_items(item_href=item_url, tag_href=tag_url)
+    return stream_json(JSONObject([
+        ('tags', inventory.export_tags()),
+        ('items', JSONList(items)),
+    ]))
+
+
+def parse_date(value):
+    ''' Parse an ISO 8601 date or date and time in UTC, or with an offset. '''
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400)
+    ### the log stores naive dates in UTC
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def log_response(name=None):
+    ''' A page of the log, newest first, from since up to until. Pass the
+        next cursor of a response to get the following page.'''
+    since = request.args.get('since')
+    until = request.args.get('until')
+    try:
+        limit = int(request.args.get('limit', LOG_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_LOG_PAGE_SIZE:
+        abort(400)
+    try:
+        entries, cursor = Log.find_page(
+            since=parse_date(since) if since else None,
+            until=parse_date(until) if until else None,
+            name=name,
+            cursor=request.args.get('cursor'),
+            limit=limit)
+    except MelangeException:
+        abort(400)
+    return json_response({
+        'entries': [entry.to_data() for entry in entries],
+        'next': cursor,
+    })
+
+
+@melange_api.route('/log/', methods=['GET'])
+@session_auth_test
+@basic_auth
+@conditional
+def show_log():
+    return log_response(request.args.get('name'))
 
-def keep_only(groups, data):
-    ansible_data = {'_meta': {'hostvars': {}}}
-    keep = []
-    for keep_group in groups:
-        if keep_group in data:
-            keep.extend([host for host in data[keep_group]['hosts']])
-    for group, group_def in data.items():
-        if group == '_meta':
-            continue
-        hosts = group_def['hosts']
-        ansible_data[group] = {
-            'hosts': [host for host in hosts if host in keep]}
-    for item, vars in data['_meta']['hostvars'].items():
-        if item in keep:
-            ansible_data['_meta']['hostvars'][item] = vars
-    return ansible_data
+
+@melange_api.route('/log/archive/', methods=['GET'])
+@session_auth_test
+@basic_auth
+@conditional
+def show_archived_log():
+    ''' Archived log entries, newest first, from since up to until. '''
+    since = request.args.get('since')
+    until = request.args.get('until')
+    entries = iter_archived_log(app.config['LOG_ARCHIVE_DIR'],
+        since=parse_date(since) if since else None,
+        until=parse_date(until) if until else None,
+        name=request.args.get('name'))
+    return stream_json(JSONObject([('entries', JSONList(entries))]))
+
+
+@melange_api.route('/item/<name>/history/', methods=['GET'])
+@session_auth_test
+@basic_auth
+@conditional
+def item_history(name):
+    if not Item.find(name):
+        abort(404)
+    return log_response(name)
+
+
+@melange_api.route('/tag/<name>/history/', methods=['GET'])
+@session_auth_test
+@basic_auth
+@conditional
+def tag_history(name):
+    if not Tag.find(name):
+        abort(404)
+    return log_response(name)
 
 
 @melange_api.route('/ansible_inventory/', methods=['GET'])
 @session_auth_test
 @basic_auth
+@conditional
 def ansible_inventory():
-    data = {}
-    for tag in Tag.find_all():
-        data[tag.name] = {'hosts': [host.name for host in tag.items]}
-    data['_meta'] = {'hostvars': {}}
-    for item in Item.find_all():
-        vars = {}
-        for var in item.to_data()['vars']:
-            vars[var['key']] = var['value']
-        data['_meta']['hostvars'][item.name] = vars
+    ''' All tags as groups, but only with the hosts in one of the
+        ansible_groups. The variables come first, in batches of items.'''
     ansible_groups = ['linux', 'ansible-managed']
-    return json_response(keep_only(ansible_groups, data))
+    keep = find_item_names(ansible_groups)
+
+    def hostvars():
+        for inventory in Inventory.load_batches():
+            for item_id, item_name in inventory.items.items():
+                if item_name in keep:
+                    yield item_name, dict(sorted(inventory.get_all_variables(item_id).items()))
+
+    def groups():
+        yield '_meta', JSONObject([('hostvars', JSONObject(hostvars()))])
+        for tag, item_names in iter_tag_items():
+            yield tag.name, {'hosts': [name for name in item_names if name in keep]}
+    return stream_json(JSONObject(groups()))
 
 
 @melange_api.route('/tag/<name>/', methods=['GET', 'POST', 'DELETE', 'PUT'])
 @session_auth_test
 @basic_auth
+@conditional
+@retry_on_lock
 def show_tag(name):
     tag = Tag.find(name)
     if not tag:
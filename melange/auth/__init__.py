@@ -20,7 +20,10 @@ from functools import wraps
 from flask import Blueprint, abort, g, redirect, request, session, url_for, make_response, render_template
 from passlib.hash import sha256_crypt
 
-from melange import User
+from melange import Token, User
+from melange.cache import credential_cache
+from melange.database import retry_on_lock
+from melange.instrumentation import measure
 
 user_auth = Blueprint('user_auth', __name__, template_folder='templates')
 
@@ -45,19 +48,38 @@ def session_auth_test(f):
     return decorated
 
 
-def basic_auth(f):
-    def check_auth(auth):
-        user = User.find(auth.username)
-        if not user or not user.authenticate(auth.password):
-            return False
+def check_password(username, password):
+    if credential_cache.verified(username, password):
         return True
+    generation = credential_cache.generation
+    user = User.find(username)
+    if not user or not user.authenticate(password):
+        return False
+    credential_cache.add(username, password, generation)
+    return True
+
+
+def request_user():
+    ''' The name of the user the request authenticates as, or None. '''
+    if 'username' in session:
+        return session['username']
+    scheme, _, value = request.headers.get('Authorization', '').partition(' ')
+    with measure('auth'):
+        if scheme.lower() == 'bearer':
+            token = Token.find_by_value(value.strip())
+            return token.user_name if token is not None else None
+        auth = request.authorization
+        if auth and check_password(auth.username, auth.password):
+            return auth.username
+    return None
+
 
+def basic_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         if hasattr(g, 'authenticated') and g.authenticated:
             return f(*args, **kwargs)
-        auth = request.authorization
-        if not auth or not check_auth(auth):
+        if request_user() is None:
             resp = make_response('Authentication Required', 401)
             resp.headers['WWW-Authenticate'] = 'Basic realm="Login required"'
             return resp
@@ -68,6 +90,7 @@ def basic_auth(f):
 
 @user_auth.route('/', methods=['GET', 'POST'])
 @session_auth
+@retry_on_lock
 def list_users():
     if request.method == 'POST':
         if 'add-user' in request.form:
@@ -84,8 +107,10 @@ def list_users():
 
 @user_auth.route('/user/<name>', methods=['GET', 'POST'])
 @session_auth
+@retry_on_lock
 def show_user(name):
     user = User.find(name)
+    token_value = None
     if request.method == 'POST':
         if 'remove-user' in request.form:
             user.remove()
@@ -94,7 +119,16 @@ def show_user(name):
             user_password = request.form['user-password']
             user.password = user_password
             user.save()
-    return render_template('user.html', user=user)
+        elif 'add-token' in request.form:
+            token_value = user.add_token(request.form['token-description'])
+            user.save()
+        elif 'remove-token' in request.form:
+            token_id = int(request.form['token-id'])
+            for token in user.tokens:
+                if token.id == token_id:
+                    user.remove_token(token)
+                    user.save()
+    return render_template('user.html', user=user, token_value=token_value)
 
 
 @user_auth.route('/login', methods=['GET', 'POST'])
@@ -0,0 +1,269 @@
+# (c) 2013, Jeroen Hoekx <jeroen.hoekx@dsquare.be>
+#
+# This file is part of Melange.
+#
+# Melange is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Melange is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Melange.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+
+from sqlalchemy import and_, bindparam
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from melange import MelangeException
+from melange.database import db_session
+from melange.models import (CHUNK_SIZE, Item, Tag, Variable, VariableResolver, bump_revision,
+                            forget_parsed_variables, items_to_items, items_to_tags, variables_from_data)
+
+
+def chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start+CHUNK_SIZE]
+
+
+def find_missing(referenced, found, defined):
+    return sorted(set(referenced) - set(found) - set(defined))
+
+
+def load_links(table, owner_column, target_class, target_column, owner_ids):
+    ''' Map every owner id on a dict of the related ids and names. '''
+    links = dict((owner_id, {}) for owner_id in owner_ids)
+    for chunk in chunks(owner_ids):
+        query = db_session.query(owner_column, target_class.id, target_class.name)\
+            .join(target_class, target_class.id==target_column)\
+            .filter(owner_column.in_(chunk))
+        for owner_id, target_id, target_name in query:
+            links[owner_id][target_id] = target_name
+    return links
+
+
+def is_named_list(entries):
+    return isinstance(entries, list) and all(isinstance(entry, dict) and isinstance(entry.get('name'), str)
+                                             for entry in entries)
+
+
+def check_document(data):
+    ''' Raise a MelangeException for a document that can not be imported. '''
+    if not isinstance(data, dict):
+        raise MelangeException('The document must be an object')
+    for kind in ['tags', 'items']:
+        entries = data.get(kind, [])
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            raise MelangeException('The %s must be a list of objects'%(kind))
+        if not is_named_list(entries):
+            raise MelangeException('Every tag and item needs a name')
+        for entry in entries:
+            vars = entry.get('vars', {})
+            if isinstance(vars, list):
+                valid = all(isinstance(var, dict) and 'key' in var and 'value' in var for var in vars)
+            else:
+                valid = isinstance(vars, dict)
+            if not valid:
+                raise MelangeException('The vars of %s must be an object or a list of keys and values'%(entry['name']))
+    for item_data in data.get('items', []):
+        for kind in ['tags', 'children']:
+            if not is_named_list(item_data.get(kind, [])):
+                raise MelangeException('The %s of %s must be a list of objects with a name'%(kind, item_data['name']))
+
+
+def create(cls, names, found):
+    ''' Insert the rows of the objects that were not found and add them to
+        found. They have no variables yet, so those are not loaded.'''
+    names = [name for name in dict.fromkeys(names) if name not in found]
+    for chunk in chunks(names):
+        db_session.execute(cls.__table__.insert(), [{'name': name} for name in chunk])
+    created = cls.find_by_names(names)
+    for obj in created.values():
+        set_committed_value(obj, 'variable_rows', [])
+        obj._created()
+    found.update(created)
+    return len(created)
+
+
+def update_variables(obj, new_variables, inherited, overwrite, summary, changes):
+    ''' The same rules as Item.update_from and Tag.update_from. The rows
+        to write are gathered in changes, see write_variables.'''
+    if obj in changes['objects']:
+        ### listed twice, the rows of the first time need their ids
+        write_variables(changes)
+    ### kept up to date, items inherit the new values of tags
+    current = obj._parsed_variables()
+    rows = obj.variable_rows
+    changed = False
+    if overwrite:
+        for k in list(current):
+            if k not in new_variables:
+                del current[k]
+                changes['removed'].append({'b_id': rows[k].id})
+                obj._log_variable(k, None, True, False)
+                summary['variables']['removed'] += 1
+                changed = True
+    for k, v in new_variables.items():
+        if k in current:
+            if v == current[k]:
+                continue
+            changes['changed'].append({'b_id': rows[k].id, 'value': json.dumps(v)})
+        elif k not in inherited or v != inherited[k]:
+            changes['added'].append({'owner_type': obj.variable_owner, 'owner_id': obj.id, 'key': k, 'value': json.dumps(v)})
+        else:
+            continue
+        obj._log_variable(k, v, k in current, True)
+        current[k] = v
+        summary['variables']['set'] += 1
+        changed = True
+    if changed:
+        changes['objects'].add(obj)
+
+
+def write_variables(changes):
+    ''' Write the gathered variable rows in batches. The objects load them
+        again when they are used.'''
+    table = Variable.__table__
+    for chunk in chunks(changes['removed']):
+        db_session.execute(table.delete().where(table.c.id==bindparam('b_id')), chunk)
+    for chunk in chunks(changes['changed']):
+        db_session.execute(table.update().where(table.c.id==bindparam('b_id')), chunk)
+    for chunk in chunks(changes['added']):
+        db_session.execute(table.insert(), chunk)
+    for obj in changes['objects']:
+        db_session.expire(obj, ['variable_rows'])
+        forget_parsed_variables(obj)
+        obj._invalidate()
+    for rows in changes.values():
+        rows.clear()
+
+
+def import_data(data, overwrite=True):
+    ''' Import a {"tags": [...], "items": [...]} document as written by
+        scripts/json_export.py in a single transaction and return a summary.
+
+        Tags are created or get their variables updated. Items are created
+        or get their tags, children and variables updated. With overwrite,
+        whatever is not in the document is removed, like a PUT of each
+        tag and item does. Otherwise the document is merged into the
+        existing data.'''
+    check_document(data)
+    tags_data = data.get('tags', [])
+    items_data = data.get('items', [])
+    summary = {
+        'tags': {'created': 0, 'updated': 0},
+        'items': {'created': 0, 'updated': 0},
+        'memberships': {'added': 0, 'removed': 0},
+        'children': {'added': 0, 'removed': 0},
+        'variables': {'set': 0, 'removed': 0},
+    }
+
+    variable_changes = {'added': [], 'changed': [], 'removed': [], 'objects': set()}
+
+    try:
+        ### resolve all names at once
+        tag_names = [tag_data['name'] for tag_data in tags_data]
+        item_names = [item_data['name'] for item_data in items_data]
+        tag_refs = [tag['name'] for item_data in items_data for tag in item_data.get('tags', [])]
+        child_refs = [child['name'] for item_data in items_data for child in item_data.get('children', [])]
+        tags = Tag.find_by_names(tag_names + tag_refs, selectinload(Tag.variable_rows))
+        items = Item.find_by_names(item_names + child_refs, selectinload(Item.variable_rows))
+        missing_tags = find_missing(tag_refs, tags, tag_names)
+        if missing_tags:
+            raise MelangeException("Tags not found: %s"%(', '.join(missing_tags)))
+        missing_children = find_missing(child_refs, items, item_names)
+        if missing_children:
+            raise MelangeException("Children not found: %s"%(', '.join(missing_children)))
+
+        ### tags and items
+        summary['tags']['created'] = create(Tag, tag_names, tags)
+        summary['tags']['updated'] = len(tag_names) - summary['tags']['created']
+        summary['items']['created'] = create(Item, item_names, items)
+        summary['items']['updated'] = len(item_names) - summary['items']['created']
+        for tag_data in tags_data:
+            update_variables(tags[tag_data['name']], variables_from_data(tag_data.get('vars', {})), {},
+                             overwrite, summary, variable_changes)
+
+        item_ids = [items[item_data['name']].id for item_data in items_data]
+        current_tags = load_links(items_to_tags, items_to_tags.c.item_id, Tag, items_to_tags.c.tag_id, item_ids)
+        current_children = load_links(items_to_items, items_to_items.c.parent_id, Item, items_to_items.c.child_id, item_ids)
+        if not overwrite:
+            ### items keep their other tags and inherit from them
+            kept = [name for links in current_tags.values() for name in links.values() if name not in tags]
+            tags.update(Tag.find_by_names(kept, selectinload(Tag.variable_rows)))
+        links_to_add = []
+        links_to_remove = []
+        children_to_add = []
+        children_to_remove = []
+        resolver = VariableResolver()
+        for item_data in items_data:
+            item = items[item_data['name']]
+            new_tags = [tags[tag['name']] for tag in item_data.get('tags', [])]
+            new_tag_ids = set(tag.id for tag in new_tags)
+            changed = False
+            for tag in new_tags:
+                if tag.id not in current_tags[item.id]:
+                    current_tags[item.id][tag.id] = tag.name
+                    links_to_add.append({'item_id': item.id, 'tag_id': tag.id})
+                    item._log_link('tags', tag.name, True)
+                    changed = True
+            if overwrite:
+                for tag_id, tag_name in list(current_tags[item.id].items()):
+                    if tag_id not in new_tag_ids:
+                        links_to_remove.append({'b_item_id': item.id, 'b_tag_id': tag_id})
+                        item._log_link('tags', tag_name, False)
+                        changed = True
+            if changed:
+                item._invalidate()
+
+            new_children = [items[child['name']] for child in item_data.get('children', [])]
+            new_child_ids = set(child.id for child in new_children)
+            for child in new_children:
+                if child.id not in current_children[item.id]:
+                    current_children[item.id][child.id] = child.name
+                    children_to_add.append({'parent_id': item.id, 'child_id': child.id})
+                    item._log_link('children', child.name, True)
+            if overwrite:
+                for child_id, child_name in list(current_children[item.id].items()):
+                    if child_id not in new_child_ids:
+                        children_to_remove.append({'b_parent_id': item.id, 'b_child_id': child_id})
+                        item._log_link('children', child_name, False)
+
+            if overwrite:
+                inherited = resolver.tag_layer(new_tags)
+            else:
+                inherited = resolver.tag_layer([tags[name] for name in current_tags[item.id].values()])
+            update_variables(item, variables_from_data(item_data.get('vars', {})), inherited, overwrite, summary,
+                             variable_changes)
+
+        write_variables(variable_changes)
+
+        if links_to_add:
+            db_session.execute(items_to_tags.insert(), links_to_add)
+        if links_to_remove:
+            db_session.execute(items_to_tags.delete().where(and_(
+                items_to_tags.c.item_id==bindparam('b_item_id'),
+                items_to_tags.c.tag_id==bindparam('b_tag_id'))), links_to_remove)
+        if children_to_add:
+            db_session.execute(items_to_items.insert(), children_to_add)
+        if children_to_remove:
+            db_session.execute(items_to_items.delete().where(and_(
+                items_to_items.c.parent_id==bindparam('b_parent_id'),
+                items_to_items.c.child_id==bindparam('b_child_id'))), children_to_remove)
+        summary['memberships'] = {'added': len(links_to_add), 'removed': len(links_to_remove)}
+        summary['children'] = {'added': len(children_to_add), 'removed': len(children_to_remove)}
+
+        bump_revision()
+        db_session.commit()
+    except:
+        db_session.rollback()
+        raise
+    return summary
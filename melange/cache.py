@@ -0,0 +1,116 @@
+# (c) 2013, Jeroen Hoekx <jeroen.hoekx@dsquare.be>
+#
+# This file is part of Melange.
+#
+# Melange is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Melange is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Melange.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from melange import app
+
+
+class TTLCache(object):
+    ''' A thread safe least recently used cache of at most size entries,
+        which expire ttl seconds after they were added. A size of 0
+        disables the cache.'''
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, predicate):
+        ''' Remove all entries for which predicate(value) is true. '''
+        with self.lock:
+            for key in [key for key, (expires, value) in self.entries.items() if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class CredentialCache(TTLCache):
+    ''' Remembers verified user names and passwords. Entries are keyed by
+        an HMAC with a per process secret, so passwords are never kept.
+
+        Invalidation only reaches the current process, other processes
+        forget changed passwords after ttl seconds.'''
+
+    def __init__(self, size, ttl):
+        super(CredentialCache, self).__init__(size, ttl)
+        self.secret = os.urandom(32)
+        self.generation = 0
+
+    def digest(self, username, password):
+        message = ('%s\0%s' % (username, password)).encode('utf-8')
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def verified(self, username, password):
+        return self.get(self.digest(username, password)) == username
+
+    def add(self, username, password, generation):
+        ''' Remember a verified password, unless an invalidation happened
+            since generation was read before verifying it. '''
+        with self.lock:
+            if generation != self.generation:
+                return
+        self.set(self.digest(username, password), username)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.generation += 1
+        self.discard(lambda cached_username: cached_username == username)
+
+
+credential_cache = CredentialCache(app.config['AUTH_CACHE_SIZE'], app.config['AUTH_CACHE_TTL'])
@@ -17,9 +17,66 @@
 
 import os
 
+def environ_bool(name, default):
+    if name not in os.environ:
+        return default
+    return os.environ[name].lower() in ['1', 'true', 'yes', 'on']
+
+def environ_optional(name, default, convert=str):
+    ''' An empty value or 'none' is None. '''
+    if name not in os.environ:
+        return default
+    value = os.environ[name].strip()
+    if value.lower() in ['', 'none']:
+        return None
+    return convert(value)
+
 class Config(object):
     DEBUG = False
     TESTING = False
+    ### connections per worker process are at most the pool size plus the
+    ### overflow, the pool settings do not apply to SQLite
+    DATABASE_POOL_SIZE = 5
+    DATABASE_MAX_OVERFLOW = 5
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_PRE_PING = True
+    ### milliseconds, PostgreSQL only
+    DATABASE_STATEMENT_TIMEOUT = None
+    ### GET requests read from one of these
+    DATABASE_REPLICA_URLS = []
+    DATABASE_REPLICA_CHECK_INTERVAL = 30
+    ### requests that write start over when SQLite stays locked
+    DATABASE_LOCK_RETRIES = 3
+    ### PRAGMA values for every SQLite connection, None leaves the default
+    SQLITE_JOURNAL_MODE = 'wal'
+    SQLITE_BUSY_TIMEOUT = 5000
+    SQLITE_SYNCHRONOUS = 'normal'
+    SQLITE_CACHE_SIZE = -16000
+    SQLITE_MMAP_SIZE = 268435456
+    ### verified API credentials, per process
+    AUTH_CACHE_SIZE = 1024
+    AUTH_CACHE_TTL = 300
+    ### runserver.py --archive-log
+    LOG_ARCHIVE_DIR = 'log-archive'
+    LOG_RETENTION_DAYS = 365
+    ### 'async' writes the log from a background thread, see melange.logwriter
+    LOG_WRITER = 'sync'
+    LOG_WRITER_WAL_DIR = None
+    LOG_WRITER_INTERVAL = 1.0
+    ### per request statistics, see melange.instrumentation
+    SERVER_TIMING = True
+    ACCESS_LOG = False
+    ### milliseconds, slower requests are logged with their queries
+    SLOW_REQUEST_THRESHOLD = None
+    ### /metrics for Prometheus, requires prometheus_client
+    METRICS = False
+    ### profiling of single requests on demand, see melange.profiling
+    PROFILING = False
+    PROFILING_USERS = ['admin']
+    PROFILING_DIR = 'profiles'
+    PROFILING_TOP = 40
+    PROFILING_KEEP = 50
 
 class ProductionConfig(Config):
     pass
@@ -37,3 +94,33 @@ class TestingConfig(Config):
 class EnvironmentConfig(Config):
     DATABASE_URL = os.environ.get('DATABASE_URL')
     SECRET_KEY = os.environ.get('SECRET_KEY')
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', Config.DATABASE_POOL_SIZE))
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', Config.DATABASE_MAX_OVERFLOW))
+    DATABASE_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT', Config.DATABASE_POOL_TIMEOUT))
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', Config.DATABASE_POOL_RECYCLE))
+    DATABASE_POOL_PRE_PING = environ_bool('DATABASE_POOL_PRE_PING', Config.DATABASE_POOL_PRE_PING)
+    DATABASE_STATEMENT_TIMEOUT = environ_optional('DATABASE_STATEMENT_TIMEOUT', Config.DATABASE_STATEMENT_TIMEOUT, int)
+    DATABASE_REPLICA_URLS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+    DATABASE_REPLICA_CHECK_INTERVAL = int(os.environ.get('DATABASE_REPLICA_CHECK_INTERVAL', Config.DATABASE_REPLICA_CHECK_INTERVAL))
+    DATABASE_LOCK_RETRIES = int(os.environ.get('DATABASE_LOCK_RETRIES', Config.DATABASE_LOCK_RETRIES))
+    SQLITE_JOURNAL_MODE = environ_optional('SQLITE_JOURNAL_MODE', Config.SQLITE_JOURNAL_MODE)
+    SQLITE_BUSY_TIMEOUT = environ_optional('SQLITE_BUSY_TIMEOUT', Config.SQLITE_BUSY_TIMEOUT, int)
+    SQLITE_SYNCHRONOUS = environ_optional('SQLITE_SYNCHRONOUS', Config.SQLITE_SYNCHRONOUS)
+    SQLITE_CACHE_SIZE = environ_optional('SQLITE_CACHE_SIZE', Config.SQLITE_CACHE_SIZE, int)
+    SQLITE_MMAP_SIZE = environ_optional('SQLITE_MMAP_SIZE', Config.SQLITE_MMAP_SIZE, int)
+    AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', Config.AUTH_CACHE_SIZE))
+    AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', Config.AUTH_CACHE_TTL))
+    LOG_ARCHIVE_DIR = os.environ.get('LOG_ARCHIVE_DIR', Config.LOG_ARCHIVE_DIR)
+    LOG_RETENTION_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', Config.LOG_RETENTION_DAYS))
+    LOG_WRITER = os.environ.get('LOG_WRITER', Config.LOG_WRITER)
+    LOG_WRITER_WAL_DIR = os.environ.get('LOG_WRITER_WAL_DIR', Config.LOG_WRITER_WAL_DIR)
+    LOG_WRITER_INTERVAL = float(os.environ.get('LOG_WRITER_INTERVAL', Config.LOG_WRITER_INTERVAL))
+    SERVER_TIMING = environ_bool('SERVER_TIMING', Config.SERVER_TIMING)
+    ACCESS_LOG = environ_bool('ACCESS_LOG', Config.ACCESS_LOG)
+    SLOW_REQUEST_THRESHOLD = environ_optional('SLOW_REQUEST_THRESHOLD', Config.SLOW_REQUEST_THRESHOLD, float)
+    METRICS = environ_bool('METRICS', Config.METRICS)
+    PROFILING = environ_bool('PROFILING', Config.PROFILING)
+    PROFILING_USERS = os.environ['PROFILING_USERS'].split(',') if 'PROFILING_USERS' in os.environ else Config.PROFILING_USERS
+    PROFILING_DIR = os.environ.get('PROFILING_DIR', Config.PROFILING_DIR)
+    PROFILING_TOP = int(os.environ.get('PROFILING_TOP', Config.PROFILING_TOP))
+    PROFILING_KEEP = int(os.environ.get('PROFILING_KEEP', Config.PROFILING_KEEP))
@@ -15,24 +15,258 @@
 # You should have received a copy of the GNU General Public License
 # along with Melange.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+import json
+import random
+import threading
+import time
+
+from functools import wraps
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import Delete, Insert, Update
 from sqlalchemy.ext.declarative import declarative_base
 
 from melange import app
 
-engine = create_engine(app.config['DATABASE_URL'])
-db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+class TimedQueuePool(QueuePool):
+    ''' A QueuePool that adds up how long checkouts wait for a connection. '''
+    def __init__(self, *args, **kwargs):
+        super(TimedQueuePool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_wait = 0.0
+        self.stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super(TimedQueuePool, self)._do_get()
+        finally:
+            with self.stats_lock:
+                self.checkouts += 1
+                self.checkout_wait += time.perf_counter() - start
+
+def engine_options(config):
+    ''' The create_engine arguments for the DATABASE_ settings. '''
+    backend = make_url(config['DATABASE_URL']).get_backend_name()
+    options = {
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+    }
+    ### SQLite uses a pool without a size
+    if backend != 'sqlite':
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': config['DATABASE_POOL_SIZE'],
+            'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+            'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+            'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        })
+    if backend == 'postgresql' and config['DATABASE_STATEMENT_TIMEOUT']:
+        options['connect_args'] = {'options': '-c statement_timeout=%d'%(config['DATABASE_STATEMENT_TIMEOUT'])}
+    return options
+
+def sqlite_pragmas(config):
+    ''' The PRAGMA statements for the SQLITE_ settings. '''
+    pragmas = []
+    for name, key in [('journal_mode', 'SQLITE_JOURNAL_MODE'),
+                      ('busy_timeout', 'SQLITE_BUSY_TIMEOUT'),
+                      ('synchronous', 'SQLITE_SYNCHRONOUS'),
+                      ('cache_size', 'SQLITE_CACHE_SIZE'),
+                      ('mmap_size', 'SQLITE_MMAP_SIZE')]:
+        if config[key] is not None:
+            pragmas.append('PRAGMA %s = %s'%(name, config[key]))
+    return pragmas
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in sqlite_pragmas(app.config):
+        cursor.execute(pragma)
+    cursor.close()
+
+def create_configured_engine(url):
+    new_engine = create_engine(url, **engine_options(dict(app.config, DATABASE_URL=url)))
+    if new_engine.dialect.name == 'sqlite':
+        event.listen(new_engine, 'connect', set_sqlite_pragmas)
+    return new_engine
+
+class ReplicaSet(object):
+    ''' Hands out the read replicas round-robin. A replica that fails a
+        SELECT 1 is skipped until it passes again, which is checked at most
+        every check_interval seconds.'''
+    def __init__(self, engines, check_interval):
+        self.engines = engines
+        self.check_interval = check_interval
+        self.position = 0
+        self.checked = {}
+        self.healthy = {}
+        self.lock = threading.Lock()
+
+    def choose(self):
+        ''' Return the next healthy replica, or None. '''
+        for attempt in range(len(self.engines)):
+            with self.lock:
+                replica = self.engines[self.position % len(self.engines)]
+                self.position += 1
+            if self.is_healthy(replica):
+                return replica
+        return None
+
+    def is_healthy(self, replica):
+        now = time.monotonic()
+        if replica not in self.checked or now - self.checked[replica] >= self.check_interval:
+            try:
+                with replica.connect() as connection:
+                    connection.execute(text('SELECT 1'))
+                self.healthy[replica] = True
+            except Exception:
+                app.logger.warning('Replica %s is not available', replica.url)
+                self.healthy[replica] = False
+            self.checked[replica] = now
+        return self.healthy[replica]
+
+class RoutingSession(Session):
+    ''' Reads from the replica in info['replica'], when there is one.
+        Writes, and everything after the first write, use the primary.'''
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = self.info.get('replica')
+        if replica is None or self.info.get('wrote'):
+            return engine
+        if self._flushing or isinstance(clause, (Insert, Update, Delete)):
+            self.info['wrote'] = True
+            return engine
+        return replica
+
+engine = create_configured_engine(app.config['DATABASE_URL'])
+replicas = ReplicaSet([create_configured_engine(url) for url in app.config['DATABASE_REPLICA_URLS']],
+                      app.config['DATABASE_REPLICA_CHECK_INTERVAL'])
+db_session = scoped_session(sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, bind=engine))
+
+def use_replica():
+    ''' Read from a replica until the session is closed. '''
+    if replicas.engines:
+        db_session.info['replica'] = replicas.choose()
 
 Base = declarative_base()
 Base.query = db_session.query_property()
 
+def pool_stats():
+    ''' The connections of the pool of this process. '''
+    pool = engine.pool
+    stats = {'class': pool.__class__.__name__}
+    ### only a QueuePool counts its connections
+    for name in ['size', 'checkedin', 'checkedout', 'overflow']:
+        if callable(getattr(pool, name, None)):
+            stats[name] = getattr(pool, name)()
+    if isinstance(pool, TimedQueuePool):
+        stats['checkouts'] = pool.checkouts
+        stats['checkout_wait'] = pool.checkout_wait
+    return stats
+
+def is_lock_error(error):
+    message = str(error.orig).lower()
+    return 'database is locked' in message or 'database table is locked' in message
+
+def retry_on_lock(f):
+    ''' Run f again, in a new transaction, when SQLite is locked by
+        another writer for longer than the busy timeout. f has to start
+        with a clean session, like a request does.'''
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        retries = app.config['DATABASE_LOCK_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                return f(*args, **kwargs)
+            except OperationalError as e:
+                if attempt == retries or not is_lock_error(e):
+                    raise
+                db_session.rollback()
+                time.sleep(random.uniform(0.5, 1) * 0.05 * 2**attempt)
+    return decorated
+
+def begin_snapshot():
+    ''' Let the following queries of this request see a single consistent
+        state of the database. The current transaction is rolled back, so
+        only use it for requests that do not write. '''
+    db_session.rollback()
+    if engine.dialect.name == 'sqlite':
+        ### pysqlite does not start a transaction for SELECT statements
+        db_session.execute(text('BEGIN'))
+    elif engine.dialect.name in ['postgresql', 'mysql']:
+        db_session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+
 def init_db():
     # import all modules here that might define models so that
     # they will be registered properly on the metadata.  Otherwise
     # you will have to import them first before calling init_db()
     import melange.models
     Base.metadata.create_all(bind=engine)
+    melange.models.bump_revision()
+    db_session.commit()
+
+def migrate_properties():
+    ''' Move the variables of items and tags from the JSON properties
+        column of older databases to the variables table. '''
+    from melange.models import Variable
+    columns = dict((table, [column['name'] for column in inspect(db_session.connection()).get_columns(table)])
+                   for table in ['items', 'tags'])
+    for table, owner_type in [('items', 'item'), ('tags', 'tag')]:
+        if 'properties' not in columns[table]:
+            continue
+        rows = []
+        query = text('SELECT id, properties FROM %s WHERE properties IS NOT NULL'%(table))
+        for owner_id, properties in db_session.execute(query).fetchall():
+            for key, value in json.loads(properties or '{}').items():
+                rows.append({
+                    'owner_type': owner_type,
+                    'owner_id': owner_id,
+                    'key': key,
+                    'value': json.dumps(value),
+                })
+        if rows:
+            db_session.execute(Variable.__table__.insert(), rows)
+        db_session.execute(text('UPDATE %s SET properties = NULL'%(table)))
+
+def add_columns():
+    ''' Add the nullable columns added to existing tables. '''
+    connection = db_session.connection()
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = [column['name'] for column in inspector.get_columns(table.name)]
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text('ALTER TABLE %s ADD COLUMN %s %s'%(table.name, column.name, column_type)))
+
+def create_indexes():
+    ''' Create the indexes added to existing tables. create_all only
+        creates the indexes of new tables. '''
+    connection = db_session.connection()
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=connection, checkfirst=True)
+
+def upgrade_db():
+    ''' Create the tables, columns and indexes added since the database was
+        initialized, migrate older data and store the resolved variables
+        of all items. '''
+    import melange.models
+    from melange.inventory import store_resolved_variables
+    Base.metadata.create_all(bind=engine)
+    add_columns()
+    create_indexes()
+    migrate_properties()
+    ### removed items used to keep theirs
+    item_ids = set(item_id for item_id, in db_session.query(melange.models.Item.id))
+    resolved = melange.models.resolved_variables
+    orphans = [item_id for item_id, in db_session.query(resolved.c.item_id) if item_id not in item_ids]
+    for start in range(0, len(orphans), melange.models.CHUNK_SIZE):
+        db_session.execute(resolved.delete().where(resolved.c.item_id.in_(orphans[start:start+melange.models.CHUNK_SIZE])))
+    store_resolved_variables(item_ids)
+    melange.models.bump_revision()
+    db_session.commit()
 
 def drop_db():
     import melange.models
@@ -0,0 +1,196 @@
+# (c) 2013, Jeroen Hoekx <jeroen.hoekx@dsquare.be>
+#
+# This file is part of Melange.
+#
+# Melange is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Melange is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Melange.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from flask import Request, request
+from flask import signals
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from melange import app
+
+### one JSON line per request when ACCESS_LOG is set
+access_log = logging.getLogger('melange.access')
+access_log.setLevel(logging.INFO)
+
+### the statistics of the request the thread is handling
+current = threading.local()
+
+### functions called with the RequestStats of every finished request
+request_listeners = []
+
+
+class RequestStats(object):
+    ''' What one request spent its time on, in seconds. '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = []
+        self.sql_time = 0.0
+        self.rows = 0
+        self.timers = {'auth': 0.0, 'json': 0.0, 'template': 0.0}
+        self.template_start = None
+        self.status = None
+
+    def count_row(self, cursor, row):
+        ''' A sqlite3 row_factory, SQLite has no row count for a SELECT. '''
+        self.rows += 1
+        return row
+
+    def duration(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        return ', '.join([
+            'db;dur=%.1f;desc="%d queries, %d rows"'%(self.sql_time * 1000, len(self.queries), self.rows),
+            'auth;dur=%.1f'%(self.timers['auth'] * 1000),
+            'json;dur=%.1f'%(self.timers['json'] * 1000),
+            'template;dur=%.1f'%(self.timers['template'] * 1000),
+            'total;dur=%.1f'%(self.duration() * 1000),
+        ])
+
+    def to_data(self):
+        return {
+            'duration': round(self.duration() * 1000, 1),
+            'queries': len(self.queries),
+            'sql': round(self.sql_time * 1000, 1),
+            'rows': self.rows,
+            'auth': round(self.timers['auth'] * 1000, 1),
+            'json': round(self.timers['json'] * 1000, 1),
+            'template': round(self.timers['template'] * 1000, 1),
+        }
+
+
+def current_stats():
+    return getattr(current, 'stats', None)
+
+
+class measure(object):
+    ''' Add the time spent in the block to a timer of the current request. '''
+    __slots__ = ['name', 'stats', 'start']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.stats = current_stats()
+        if self.stats is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        if self.stats is not None:
+            self.stats.timers[self.name] += time.perf_counter() - self.start
+
+
+class InstrumentedRequest(Request):
+    ''' Times parsing the JSON body, request.json parses it only once. '''
+
+    def get_json(self, *args, **kwargs):
+        with measure('json'):
+            return super(InstrumentedRequest, self).get_json(*args, **kwargs)
+
+
+def collecting(config):
+    return bool(config['SERVER_TIMING'] or config['ACCESS_LOG'] or config['SLOW_REQUEST_THRESHOLD'] is not None
+                or request_listeners)
+
+
+def start_request_stats():
+    if collecting(app.config):
+        current.stats = RequestStats()
+
+
+def add_server_timing(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+    stats.status = response.status_code
+    if app.config['SERVER_TIMING']:
+        ### queries of a streamed body run after the headers are sent
+        response.headers['Server-Timing'] = stats.server_timing()
+    return response
+
+
+def log_request_stats(exception=None):
+    ''' Write the access log line and the slow request warning, and stop
+        collecting.'''
+    stats = current_stats()
+    current.stats = None
+    if stats is None:
+        return
+    if exception is not None:
+        stats.status = 500
+    for listener in request_listeners:
+        listener(stats)
+    data = stats.to_data()
+    if app.config['ACCESS_LOG']:
+        line = {'method': request.method, 'path': request.full_path.rstrip('?'), 'status': stats.status}
+        line.update(data)
+        access_log.info(json.dumps(line))
+    threshold = app.config['SLOW_REQUEST_THRESHOLD']
+    if threshold is not None and data['duration'] >= threshold:
+        queries = ''.join('\n%8.1fms %s'%(duration * 1000, ' '.join(statement.split()))
+                          for statement, duration in stats.queries)
+        app.logger.warning('Slow request %s %s: %.1fms, %d queries in %.1fms%s', request.method, request.path,
+                           data['duration'], data['queries'], data['sql'], queries)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is None:
+        return
+    if isinstance(cursor, sqlite3.Cursor):
+        cursor.row_factory = stats.count_row
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    if stats is None or not conn.info.get('query_start'):
+        return
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    stats.sql_time += duration
+    stats.queries.append((statement, duration))
+    ### other drivers fetch the whole result and know its size
+    if cursor.description is not None and cursor.rowcount > 0 and not isinstance(cursor, sqlite3.Cursor):
+        stats.rows += cursor.rowcount
+
+
+def start_template(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats.template_start = time.perf_counter()
+
+
+def end_template(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats.template_start is not None:
+        stats.timers['template'] += time.perf_counter() - stats.template_start
+        stats.template_start = None
+
+
+### Flask without blinker has no signals
+if getattr(signals, 'signals_available', True):
+    signals.before_render_template.connect(start_template, app)
+    signals.template_rendered.connect(end_template, app)
@@ -0,0 +1,221 @@
+# (c) 2013, Jeroen Hoekx <jeroen.hoekx@dsquare.be>
+#
+# This file is part of Melange.
+#
+# Melange is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Melange is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Melange.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from collections import namedtuple
+
+from melange.database import db_session
+from melange.instrumentation import measure
+from melange.models import (CHUNK_SIZE, Item, Tag, Variable, VariableResolver, items_to_items,
+                            items_to_tags, resolved_variables)
+
+
+def load_variables(owner_type, owner_ids=None):
+    ''' Map the ids of all, or of the given, items or tags on their variables. '''
+    query = db_session.query(Variable.owner_id, Variable.key, Variable.value)\
+        .filter(Variable.owner_type==owner_type)
+    if owner_ids is not None:
+        query = query.filter(Variable.owner_id.in_(owner_ids))
+    rows = query.order_by(Variable.id).all()
+    variables = {}
+    with measure('json'):
+        for owner_id, key, value in rows:
+            variables.setdefault(owner_id, {})[key] = json.loads(value)
+    return variables
+
+
+InventoryTag = namedtuple('InventoryTag', ['name', 'variables'])
+
+
+class Inventory(object):
+    ''' A snapshot of all items and tags and the relations between them.
+        It is loaded in a fixed number of queries, no matter how many items
+        and tags there are. Variables are parsed only once.'''
+
+    def __init__(self):
+        self.tags = {}
+        self.items = {}
+        self.item_variables = {}
+        self.item_tags = {}
+        self.tag_items = {}
+        self.children = {}
+        self.stored_variables = {}
+        self.resolver = VariableResolver()
+
+    @classmethod
+    def load(cls, item_ids=None):
+        ''' Load everything, or only the given items with their tags.
+            Stored resolved variables are only loaded for a full snapshot.'''
+        inventory = cls()
+        items = db_session.query(Item.id, Item.name)
+        if item_ids is None:
+            inventory.load_tags()
+            inventory.load_items(items.order_by(Item.id), stored=True)
+        else:
+            links = db_session.query(items_to_tags.c.item_id, items_to_tags.c.tag_id)\
+                .filter(items_to_tags.c.item_id.in_(item_ids)).all()
+            inventory.load_tags(set(tag_id for item_id, tag_id in links))
+            inventory.load_items(items.filter(Item.id.in_(item_ids)).order_by(Item.id), item_ids, links)
+        return inventory
+
+    @classmethod
+    def load_batches(cls, batch_size=CHUNK_SIZE):
+        ''' Yield snapshots of all tags and the next batch_size items, in the
+            order of the items. Memory use depends on the batch size instead
+            of on the number of items. Children outside a batch are left out.'''
+        tags = cls()
+        tags.load_tags()
+        last_id = 0
+        while True:
+            rows = db_session.query(Item.id, Item.name)\
+                .filter(Item.id > last_id).order_by(Item.id).limit(batch_size).all()
+            if not rows:
+                return
+            inventory = cls()
+            inventory.tags = tags.tags
+            inventory.tag_items = dict((tag_id, []) for tag_id in tags.tags)
+            inventory.resolver = tags.resolver
+            inventory.load_items(rows, [row[0] for row in rows], stored=True)
+            yield inventory
+            last_id = rows[-1][0]
+
+    def load_tags(self, tag_ids=None):
+        tags = db_session.query(Tag.id, Tag.name)
+        if tag_ids is not None:
+            tags = tags.filter(Tag.id.in_(tag_ids))
+        variables = load_variables('tag', tag_ids)
+        for id, name in tags.order_by(Tag.id):
+            self.tags[id] = InventoryTag(name, variables.get(id, {}))
+            self.tag_items[id] = []
+
+    def load_items(self, rows, item_ids=None, links=None, stored=False):
+        ''' Add (id, name) item rows with their variables and relations.
+            item_ids restricts the relations, None loads all of them.'''
+        variables = load_variables('item', item_ids)
+        for id, name in rows:
+            self.items[id] = name
+            self.item_variables[id] = variables.get(id, {})
+            self.item_tags[id] = []
+            self.children[id] = []
+        children = db_session.query(items_to_items.c.parent_id, items_to_items.c.child_id)
+        stored_variables = db_session.query(resolved_variables.c.item_id, resolved_variables.c.data)
+        if links is None:
+            links = db_session.query(items_to_tags.c.item_id, items_to_tags.c.tag_id)
+            if item_ids is not None:
+                links = links.filter(items_to_tags.c.item_id.in_(item_ids))
+        if item_ids is not None:
+            children = children.filter(items_to_items.c.parent_id.in_(item_ids))
+            stored_variables = stored_variables.filter(resolved_variables.c.item_id.in_(item_ids))
+
+        for item_id, tag_id in links:
+            if item_id in self.items and tag_id in self.tags:
+                self.item_tags[item_id].append(tag_id)
+                self.tag_items[tag_id].append(item_id)
+        for parent_id, child_id in children:
+            if parent_id in self.items and child_id in self.items:
+                self.children[parent_id].append(child_id)
+        if stored:
+            for item_id, data in stored_variables:
+                self.stored_variables[item_id] = data
+
+    def get_all_variables(self, item_id):
+        ''' Same precedence as Item.get_all_variables. '''
+        if item_id in self.stored_variables:
+            with measure('json'):
+                return dict((k, v) for k, v, tag_name in json.loads(self.stored_variables[item_id]))
+        tags = [self.tags[tag_id] for tag_id in self.item_tags[item_id]]
+        return self.resolver.resolve(tags, self.item_variables[item_id])
+
+    def resolve_origins(self, item_id):
+        tags = [self.tags[tag_id] for tag_id in self.item_tags[item_id]]
+        return self.resolver.resolve_origins(tags, self.item_variables[item_id])
+
+    def export_tags(self):
+        return [{'name': tag.name, 'vars': tag.variables} for tag in self.tags.values()]
+
+    def export_items(self, item_href=None, tag_href=None):
+        ''' Yield the data of every item in a tag, in the order they first
+            appear in the tags, with only their own variables.
+            The href functions take the name of an item or tag.'''
+        seen = set()
+        for tag_id in self.tags:
+            for item_id in self.tag_items[tag_id]:
+                if item_id in seen:
+                    continue
+                seen.add(item_id)
+                data = {
+                    'name': self.items[item_id],
+                    'tags': [],
+                    'children': [],
+                }
+                for item_tag_id in self.item_tags[item_id]:
+                    tag_data = {'name': self.tags[item_tag_id].name}
+                    if tag_href:
+                        tag_data['href'] = tag_href(tag_data['name'])
+                    data['tags'].append(tag_data)
+                for child_id in self.children[item_id]:
+                    child_data = {'name': self.items[child_id]}
+                    if item_href:
+                        child_data['href'] = item_href(child_data['name'])
+                    data['children'].append(child_data)
+                data['vars'] = [{'key': k, 'value': v} for k, v in sorted(self.item_variables[item_id].items())]
+                yield data
+
+
+def find_item_names(tag_names):
+    ''' Return the names of all items in any of the given tags. '''
+    query = db_session.query(Item.name)\
+        .join(items_to_tags, items_to_tags.c.item_id==Item.id)\
+        .join(Tag, Tag.id==items_to_tags.c.tag_id)\
+        .filter(Tag.name.in_(tag_names))
+    return set(name for name, in query)
+
+
+def iter_tag_items(batch_size=CHUNK_SIZE):
+    ''' Yield every tag with the names of its items, loading batch_size
+        tags at a time.'''
+    last_id = 0
+    while True:
+        tags = db_session.query(Tag.id, Tag.name)\
+            .filter(Tag.id > last_id).order_by(Tag.id).limit(batch_size).all()
+        if not tags:
+            return
+        members = dict((tag_id, []) for tag_id, name in tags)
+        query = db_session.query(items_to_tags.c.tag_id, Item.name)\
+            .join(Item, Item.id==items_to_tags.c.item_id)\
+            .filter(items_to_tags.c.tag_id.in_(list(members)))
+        for tag_id, item_name in query:
+            members[tag_id].append(item_name)
+        variables = load_variables('tag', list(members))
+        for tag_id, name in tags:
+            yield InventoryTag(name, variables.get(tag_id, {})), members[tag_id]
+        last_id = tags[-1][0]
+
+
+def store_resolved_variables(item_ids):
+    ''' Recompute and store the resolved variables of the given items.
+        Items that no longer exist lose their stored variables.'''
+    item_ids = sorted(item_ids)
+    for start in range(0, len(item_ids), CHUNK_SIZE):
+        chunk = item_ids[start:start+CHUNK_SIZE]
+        db_session.execute(resolved_variables.delete().where(resolved_variables.c.item_id.in_(chunk)))
+        inventory = Inventory.load(chunk)
+        rows = [{'item_id': item_id, 'data': json.dumps(inventory.resolve_origins(item_id))}
+                for item_id in inventory.items]
+        if rows:
+            db_session.execute(resolved_variables.insert(), rows)
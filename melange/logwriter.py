@@ -0,0 +1,202 @@
+# (c) 2013, Jeroen Hoekx <jeroen.hoekx@dsquare.be>
+#
+# This file is part of Melange.
+#
+# Melange is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Melange is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Melange.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import json
+import os
+import threading
+
+from datetime import datetime
+
+from melange import app
+from melange.database import engine
+
+
+class AsyncLogWriter(object):
+    ''' Inserts log rows from a background thread, in batches, outside of
+        the transactions that made the changes.
+        With a wal_dir, every process appends its rows to a file in that
+        directory before they are queued and only removes it after they
+        are inserted. The files of processes that are gone are inserted
+        when a writer starts, so after a crash an entry can be written
+        twice, but is not lost.
+        on_insert is called with the connection of every batch, before it
+        commits.'''
+
+    def __init__(self, table, wal_dir=None, interval=1.0, bind=engine, on_insert=None):
+        self.table = table
+        self.on_insert = on_insert
+        self.wal_dir = wal_dir
+        self.interval = interval
+        self.bind = bind
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        ''' Insert the rows of earlier processes and start the thread. '''
+        ### what a parent process queued is its own to write
+        self.pending = []
+        self.segment = 0
+        self.segments = []
+        self.stopping = False
+        self.pid = os.getpid()
+        self.replay()
+        self.thread = threading.Thread(target=self.run, name='melange-log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wal_path(self):
+        return os.path.join(self.wal_dir, '%d.wal'%(self.pid))
+
+    def append(self, rows):
+        if not rows:
+            return
+        ### threads do not survive a fork of the worker processes
+        if self.pid != os.getpid():
+            self.start()
+        with self.lock:
+            if self.wal_dir:
+                with open(self.wal_path(), 'a') as f:
+                    for row in rows:
+                        f.write(json.dumps(dict(row, date=row['date'].isoformat())) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.pending.extend(rows)
+
+    def run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                ### the rows are queued again, try later
+                app.logger.exception('Writing the log failed')
+
+    def flush(self):
+        ''' Insert all queued rows. '''
+        if self.pid != os.getpid():
+            return
+        with self.flush_lock:
+            with self.lock:
+                rows = self.pending
+                self.pending = []
+                if self.wal_dir and os.path.exists(self.wal_path()):
+                    ### new rows go to a new file while these are inserted
+                    self.segment += 1
+                    segment = '%s.%d'%(self.wal_path(), self.segment)
+                    os.rename(self.wal_path(), segment)
+                    self.segments.append(segment)
+                segments = list(self.segments)
+            try:
+                if rows:
+                    self.insert(rows)
+            except Exception:
+                with self.lock:
+                    self.pending[:0] = rows
+                raise
+            for segment in segments:
+                os.remove(segment)
+                self.segments.remove(segment)
+
+    def insert(self, rows):
+        with self.bind.begin() as connection:
+            connection.execute(self.table.insert(), rows)
+            if self.on_insert is not None:
+                self.on_insert(connection)
+
+    def replay(self):
+        ''' Insert the rows left in the files of processes that are gone. '''
+        if not self.wal_dir:
+            return
+        if not os.path.isdir(self.wal_dir):
+            os.makedirs(self.wal_dir)
+        for filename in sorted(os.listdir(self.wal_dir), key=wal_order):
+            owner = wal_owner(filename)
+            ### a file of our own pid is left by an earlier process
+            if owner is None or (owner != self.pid and process_exists(owner)):
+                continue
+            path = os.path.join(self.wal_dir, filename)
+            claimed = '%s.claimed-%d'%(path, self.pid)
+            try:
+                ### only one of the starting processes gets it
+                os.rename(path, claimed)
+            except OSError:
+                continue
+            rows = []
+            with open(claimed) as f:
+                for line in f:
+                    ### the last line is incomplete after a crash while writing
+                    if not line.endswith('\n'):
+                        break
+                    row = json.loads(line)
+                    row['date'] = datetime.fromisoformat(row['date'])
+                    rows.append(row)
+            if rows:
+                self.insert(rows)
+            os.remove(claimed)
+
+    def stop(self):
+        ''' Stop the thread and insert what is left. '''
+        if self.pid != os.getpid():
+            return
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+
+def wal_order(filename):
+    ''' Order the files of a process by the segment number, the current
+        file last.'''
+    parts = filename.split('.')
+    segment = [int(part) for part in parts[2:3] if part.isdigit()]
+    return parts[0], segment or [float('inf')]
+
+
+def wal_owner(filename):
+    ''' The pid of the process that writes or replays a file. '''
+    if '.wal' not in filename:
+        return None
+    owner = filename.split('.claimed-')[-1] if '.claimed-' in filename else filename.split('.')[0]
+    if not owner.isdigit():
+        return None
+    return int(owner)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def create_log_writer(table, on_insert=None):
+    ''' Return the writer configured by LOG_WRITER, or None to write the
+        log in the transaction of the changes.'''
+    if app.config['LOG_WRITER'] != 'async':
+        return None
+    writer = AsyncLogWriter(table, app.config['LOG_WRITER_WAL_DIR'], app.config['LOG_WRITER_INTERVAL'],
+                           on_insert=on_insert)
+    atexit.register(writer.stop)
+    return writer
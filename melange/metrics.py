@@ -0,0 +1,129 @@
+# (c) 2013, Jeroen Hoekx <jeroen.hoekx@dsquare.be>
+#
+# This file is part of Melange.
+#
+# Melange is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Melange is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Melange.  If not, see <http://www.gnu.org/licenses/>.
+
+### Prometheus metrics at /metrics, imported when METRICS is set. With
+### several worker processes, set PROMETHEUS_MULTIPROC_DIR to an empty
+### directory, so every worker answers for all of them.
+
+import os
+import threading
+
+from flask import make_response, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest)
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import func
+
+from melange import app
+from melange.auth import basic_auth, session_auth_test
+from melange.cache import credential_cache
+from melange.database import TimedQueuePool, db_session, engine, replicas
+from melange.instrumentation import request_listeners
+from melange.models import Item, Log, Tag
+
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+
+request_duration = Histogram('melange_request_duration_seconds', 'Time to answer a request.',
+                             ['blueprint', 'rule', 'method'])
+requests = Counter('melange_requests', 'Answered requests.', ['blueprint', 'rule', 'method', 'status'])
+request_queries = Histogram('melange_request_queries', 'Queries per request.', ['blueprint', 'rule'],
+                            buckets=QUERY_BUCKETS)
+request_sql_duration = Histogram('melange_request_sql_seconds', 'Time per request spent in queries.',
+                                 ['blueprint', 'rule'])
+auth_duration = Histogram('melange_auth_verify_seconds', 'Time to verify the credentials of a request.')
+pool_checkouts = Counter('melange_db_pool_checkouts', 'Connections taken from the pool.', ['database'])
+pool_checkout_wait = Counter('melange_db_pool_checkout_wait_seconds',
+                             'Time spent waiting for a connection from the pool.', ['database'])
+cache_hits = Counter('melange_cache_hits', 'Cache lookups that found an entry.', ['cache'])
+cache_misses = Counter('melange_cache_misses', 'Cache lookups that found nothing.', ['cache'])
+
+CACHES = {
+    'credentials': credential_cache,
+}
+
+
+class Totals(object):
+    ''' Adds what per process totals grew by to counters, which is what a
+        counter shared between processes can take.'''
+
+    def __init__(self):
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def add(self, counter, key, value):
+        with self.lock:
+            last = self.last.get(key, 0)
+            self.last[key] = value
+        ### a recreated pool starts over
+        if value < last:
+            last = 0
+        if value > last:
+            counter.inc(value - last)
+
+totals = Totals()
+
+
+def observe_request(stats):
+    rule = request.url_rule.rule if request.url_rule is not None else ''
+    blueprint = request.blueprint or ''
+    request_duration.labels(blueprint, rule, request.method).observe(stats.duration())
+    requests.labels(blueprint, rule, request.method, str(stats.status)).inc()
+    request_queries.labels(blueprint, rule).observe(len(stats.queries))
+    request_sql_duration.labels(blueprint, rule).observe(stats.sql_time)
+    if stats.timers['auth']:
+        auth_duration.observe(stats.timers['auth'])
+    for name, cache in CACHES.items():
+        totals.add(cache_hits.labels(name), ('hits', name), cache.hits)
+        totals.add(cache_misses.labels(name), ('misses', name), cache.misses)
+    for name, bind in [('primary', engine)] + [('replica-%d'%(i), replica) for i, replica in enumerate(replicas.engines)]:
+        if isinstance(bind.pool, TimedQueuePool):
+            totals.add(pool_checkouts.labels(name), ('checkouts', name), bind.pool.checkouts)
+            totals.add(pool_checkout_wait.labels(name), ('checkout_wait', name), bind.pool.checkout_wait)
+
+request_listeners.append(observe_request)
+
+
+class CountCollector(object):
+    ''' The number of items, tags and log entries, counted when scraped. '''
+
+    def collect(self):
+        for name, model, description in [('melange_items', Item, 'Items.'),
+                                         ('melange_tags', Tag, 'Tags.'),
+                                         ('melange_log_entries', Log, 'Log entries in the database.')]:
+            count = db_session.query(func.count(model.id)).scalar()
+            yield GaugeMetricFamily(name, description, value=count)
+
+
+def multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+
+
+@app.route('/metrics', methods=['GET'])
+@session_auth_test
+@basic_auth
+def metrics():
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    counts = CollectorRegistry()
+    counts.register(CountCollector())
+    response = make_response(generate_latest(registry) + generate_latest(counts), 200)
+    response.headers['Content-Type'] = CONTENT_TYPE_LATEST
+    return response
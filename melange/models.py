@@ -15,16 +15,33 @@
 # You should have received a copy of the GNU General Public License
 # along with Melange.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
+import secrets
 
 from datetime import datetime
 
+import sqlalchemy
+
 from passlib.hash import sha256_crypt
-from sqlalchemy import Column, ForeignKey, DateTime, Integer, String, Text, Table
-from sqlalchemy.orm import relationship
+from sqlalchemy import (Column, ForeignKey, Date, DateTime, Index, Integer, String, Text, Table, UniqueConstraint,
+                        and_, event, or_)
+from sqlalchemy.orm import backref, relationship, selectinload
+from sqlalchemy.orm.attributes import flag_dirty
+from sqlalchemy.orm.collections import attribute_mapped_collection
 
 from melange import MelangeException
+from melange.cache import credential_cache
 from melange.database import Base, db_session
+from melange.instrumentation import measure
+from melange.logwriter import create_log_writer
+
+### number of values in a single IN clause
+CHUNK_SIZE = 500
+
+### log entries per page
+LOG_PAGE_SIZE = 100
+LOG_CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
 items_to_tags = Table('items_to_tags', Base.metadata,
     Column('item_id', Integer, ForeignKey('items.id')),
@@ -36,25 +53,194 @@ items_to_items = Table('items_to_items', Base.metadata,
     Column('child_id', Integer, ForeignKey('items.id'), primary_key=True),
 )
 
+def tag_length(tag):
+    return len(tag.name)
+
+class VariableResolver(object):
+    ''' Merges the variables of a set of tags once and shares the result
+        between all items with the same tags. Tags with longer names win.
+        The resolver does not notice changes to tags, so keep it only for
+        the duration of a request.'''
+    def __init__(self):
+        self.layers = {}
+        self.origins = {}
+
+    def tag_layer(self, tags):
+        tags = sorted(tags, key=tag_length)
+        signature = tuple(tag.name for tag in tags)
+        layer = self.layers.get(signature)
+        if layer is None:
+            layer = {}
+            for tag in tags:
+                layer.update(tag.variables)
+            self.layers[signature] = layer
+        return layer
+
+    def tag_origins(self, tags):
+        ''' Map every tag variable on the tag it comes from. '''
+        tags = sorted(tags, key=tag_length)
+        signature = tuple(tag.name for tag in tags)
+        origins = self.origins.get(signature)
+        if origins is None:
+            origins = {}
+            for tag in tags:
+                for key in tag.variables:
+                    origins[key] = tag
+            self.origins[signature] = origins
+        return origins
+
+    def resolve(self, tags, variables):
+        vars = dict(self.tag_layer(tags))
+        vars.update(variables)
+        return vars
+
+    def resolve_origins(self, tags, variables):
+        ''' Return [key, value, tag name] for all variables, sorted by key.
+            The tag name is None for the item's own variables.'''
+        origins = self.tag_origins(tags)
+        resolved = []
+        for key, value in sorted(self.resolve(tags, variables).items()):
+            if key in variables:
+                resolved.append([key, value, None])
+            else:
+                resolved.append([key, value, origins[key].name])
+        return resolved
+
+resolved_variables = Table('resolved_variables', Base.metadata,
+    Column('item_id', Integer, ForeignKey('items.id'), primary_key=True),
+    Column('data', Text, nullable=False),
+)
+
+### number of archived log entries per day and name, see melange.retention
+archived_log = Table('archived_log', Base.metadata,
+    Column('day', Date, primary_key=True),
+    Column('name', String, primary_key=True),
+    Column('entries', Integer, nullable=False),
+)
+
+data_revision = Table('data_revision', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('revision', Integer, nullable=False),
+)
+
+def get_revision():
+    return db_session.query(data_revision.c.revision).filter(data_revision.c.id==1).scalar() or 0
+
+def bump_revision(connection=db_session):
+    ''' Increment the data revision as part of the current transaction. '''
+    result = connection.execute(data_revision.update().where(data_revision.c.id==1).values(revision=data_revision.c.revision + 1))
+    if result.rowcount == 0:
+        connection.execute(data_revision.insert().values(id=1, revision=1))
+
+def variables_from_data(vars):
+    ''' Variables are a dict, or a list of {key, value} as in to_data.
+        In a list, the item's own variables win over those of tags.'''
+    if type(vars)!=list:
+        return vars
+    result = {}
+    own_vars = [ property for property in vars if 'tag' not in property ]
+    for property in vars:
+        result[property['key']] = property['value']
+    for property in own_vars:
+        result[property['key']] = property['value']
+    return result
+
+class Variable(Base):
+    ''' A variable of an item or a tag, with a JSON encoded value. '''
+    __tablename__ = 'variables'
+    __table_args__ = (
+        UniqueConstraint('owner_type', 'owner_id', 'key'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    owner_type = Column(String, nullable=False)
+    owner_id = Column(Integer, nullable=False)
+    key = Column(String, nullable=False, index=True)
+    value = Column(Text, nullable=False)
+
+    def __init__(self, owner_type, key, value):
+        self.owner_type = owner_type
+        self.key = key
+        self.value = json.dumps(value)
+    def __repr__(self):
+        return "<Variable('%s', %s, '%s')>"%(self.owner_type, self.owner_id, self.key)
+
+    @classmethod
+    def find_owners(cls, key):
+        ''' Return the ids of the items and of the tags with this variable. '''
+        owners = {'item': set(), 'tag': set()}
+        for owner_type, owner_id in db_session.query(cls.owner_type, cls.owner_id).filter(cls.key==key):
+            owners[owner_type].add(owner_id)
+        return owners
+
+def variables_relationship(owner):
+    options = {}
+    if tuple(int(part) for part in sqlalchemy.__version__.split('.')[:2]) >= (1, 4):
+        ### items and tags both write owner_id, told apart by owner_type
+        options['overlaps'] = 'variable_rows'
+    return relationship(Variable,
+        primaryjoin="and_(Variable.owner_type=='%s', foreign(Variable.owner_id)==%s.id)"%(owner.lower(), owner),
+        collection_class=attribute_mapped_collection('key'),
+        order_by=Variable.id,
+        cascade='all, delete-orphan',
+        **options)
+
 class VariableMixin(object):
+    ''' Variables are stored one per row in the variables table. Classes
+        define variable_owner and a variable_rows relationship.
+        The rows are parsed once and changes are written at the next flush,
+        so values must be passed to set_variable after changing them.'''
+    def _parsed_variables(self):
+        variables = self.__dict__.get('_variables')
+        if variables is None:
+            rows = self.variable_rows
+            with measure('json'):
+                variables = dict((key, json.loads(row.value)) for key, row in rows.items())
+            self.__dict__['_variables'] = variables
+        return variables
+
     def get_variables(self):
-        if self.properties:
-            return json.loads(self.properties)
-        else:
-            return {}
+        return dict(self._parsed_variables())
     variables = property(get_variables)
 
+    def _changed_variable(self, key):
+        self.__dict__.setdefault('_changed_variables', set()).add(key)
+        db_session.info.setdefault('unsaved_variables', set()).add(self)
+        ### make sure the next flush happens, even with nothing else to write
+        flag_dirty(self)
+        self._invalidate()
+
     def set_variable(self, key, value):
-        vars = self.variables
-        vars[key] = value
-        self.properties = json.dumps(vars)
-        self._log("Variable '%s' set to '%s'"%(key, value))
+        variables = self._parsed_variables()
+        self._log_variable(key, value, key in variables, True)
+        variables[key] = value
+        self._changed_variable(key)
 
     def remove_variable(self, key):
-        vars = self.variables
-        del vars[key]
-        self.properties = json.dumps(vars)
-        self._log("Variable '%s' removed"%(key))
+        del self._parsed_variables()[key]
+        self._changed_variable(key)
+        self._log_variable(key, None, True, False)
+
+    def _write_variables(self):
+        variables = self._parsed_variables()
+        changed = self.__dict__.pop('_changed_variables', set())
+        rows = self.variable_rows
+        for key in changed - set(variables):
+            if key in rows:
+                del rows[key]
+        ### new rows in the order of the variables
+        for key in [key for key in variables if key in changed]:
+            if key in rows:
+                rows[key].value = json.dumps(variables[key])
+            else:
+                rows[key] = Variable(self.variable_owner, key, variables[key])
+
+def forget_parsed_variables(target, *args):
+    if target is None:
+        ### already garbage collected
+        return
+    target.__dict__.pop('_variables', None)
+    target.__dict__.pop('_changed_variables', None)
 
 class CompatMixin(object):
     @classmethod
@@ -68,18 +254,100 @@ class CompatMixin(object):
         except:
             return None
 
+    @classmethod
+    def find_by_names(cls, names, *options):
+        ''' Return a dict of name to object for all given names that exist.
+            The options are applied to the query, for eager loading.'''
+        names = sorted(set(names))
+        found = {}
+        for start in range(0, len(names), CHUNK_SIZE):
+            for obj in cls.query.options(*options).filter(cls.name.in_(names[start:start+CHUNK_SIZE])):
+                found[obj.name] = obj
+        return found
+
     def save(self):
         db_session.add(self)
+        bump_revision()
         db_session.commit()
 
     def remove(self):
         self._log('Removed')
         db_session.delete(self)
+        bump_revision()
         db_session.commit()
 
+class ChangeSet(object):
+    ''' All changes to one item, tag or user in a transaction. Changes
+        that undo each other are left out.'''
+    def __init__(self):
+        self.messages = []
+        self.links = {'tags': {}, 'children': {}}
+        self.variables = {}
+
+    def link(self, kind, name, added):
+        links = self.links[kind]
+        if links.get(name) == (not added):
+            del links[name]
+        else:
+            links[name] = added
+
+    def variable(self, key, value, existed, exists):
+        ''' Record a variable change. existed is whether the key was set
+            before this change, exists whether it is set after it.'''
+        if key in self.variables:
+            existed = self.variables[key][0]
+        self.variables[key] = (existed, exists, value)
+
+    def to_data(self):
+        data = {}
+        if self.messages:
+            data['messages'] = self.messages
+        for kind, links in self.links.items():
+            added = [name for name, is_added in links.items() if is_added]
+            removed = [name for name, is_added in links.items() if not is_added]
+            if added or removed:
+                data[kind] = {'added': added, 'removed': removed}
+        vars = {'added': {}, 'changed': {}, 'removed': []}
+        for key, (existed, exists, value) in self.variables.items():
+            if exists:
+                vars['changed' if existed else 'added'][key] = value
+            elif existed:
+                vars['removed'].append(key)
+        if vars['added'] or vars['changed'] or vars['removed']:
+            data['vars'] = vars
+        return data
+
+    @staticmethod
+    def summary(data):
+        ''' A one line description of the data of a change set. '''
+        parts = list(data.get('messages', []))
+        for kind, label in [('tags', 'Tags'), ('children', 'Children')]:
+            for action in ['added', 'removed']:
+                if data.get(kind, {}).get(action):
+                    parts.append('%s %s: %s'%(label, action, ', '.join(data[kind][action])))
+        for action in ['added', 'changed', 'removed']:
+            if data.get('vars', {}).get(action):
+                parts.append('Variables %s: %s'%(action, ', '.join(data['vars'][action])))
+        return '; '.join(parts)
+
 class LogMixin(object):
+    ''' Changes are gathered per object and written at commit as one log
+        entry per object, see write_change_sets.'''
+    def _change_set(self):
+        change_sets = db_session.info.setdefault('change_sets', {})
+        key = (self.__class__.__name__, self.name)
+        if key not in change_sets:
+            change_sets[key] = ChangeSet()
+        return change_sets[key]
+
     def _log(self, message):
-        db_session.add( Log(self.name, message) )
+        self._change_set().messages.append(message)
+
+    def _log_link(self, kind, name, added):
+        self._change_set().link(kind, name, added)
+
+    def _log_variable(self, key, value, existed, exists):
+        self._change_set().variable(key, value, existed, exists)
 
 class Item(Base, VariableMixin, CompatMixin, LogMixin):
     __tablename__ = 'items'
@@ -87,47 +355,65 @@ class Item(Base, VariableMixin, CompatMixin, LogMixin):
     id = Column(Integer, primary_key=True)
     name = Column(String(), unique=True)
     tags = relationship('Tag', secondary=items_to_tags, backref='items')
-    properties = Column(Text)
+    variable_owner = 'item'
+    variable_rows = variables_relationship('Item')
     children = relationship('Item', secondary=items_to_items, primaryjoin=id==items_to_items.c.parent_id, secondaryjoin=id==items_to_items.c.child_id, backref='parents')
 
     def __init__(self, name):
         self.name = name
-        self._log('Item created')
+        self._created()
     def __repr__(self):
         return "<Item '%s'>"%(self.name)
 
-    def get_all_variables(self):
-        def tag_length(tag):
-            return len(tag.name)
-        vars = {}
-        for tag in sorted(self.tags, key=tag_length):
-            vars.update(tag.variables)
-        vars.update(self.variables)
-        return vars
+    def _created(self):
+        self._invalidate()
+        self._log('Item created')
+
+    def _invalidate(self):
+        db_session.info.setdefault('stale_items', set()).add(self)
+
+    def remove(self):
+        ### before the item, the row refers to it
+        if self.id is not None:
+            db_session.execute(resolved_variables.delete().where(resolved_variables.c.item_id==self.id))
+        super(Item, self).remove()
+
+    def get_stored_variables(self):
+        ''' Return the resolved variables as stored at the last commit, as
+            [key, value, tag name] sorted by key. Returns None when nothing
+            is stored or when uncommitted changes might affect them.'''
+        if self.id is None or db_session.info.get('stale_items') or db_session.info.get('stale_tags'):
+            return None
+        data = db_session.query(resolved_variables.c.data).filter(resolved_variables.c.item_id==self.id).scalar()
+        if data is None:
+            return None
+        with measure('json'):
+            return json.loads(data)
+
+    def get_all_variables(self, resolver=None):
+        if resolver is None:
+            resolver = VariableResolver()
+        return resolver.resolve(self.tags, self.variables)
 
     def add_to(self, tag):
         self.tags.append(tag)
-        self._log('Tag %s added'%(tag.name))
+        self._log_link('tags', tag.name, True)
 
     def remove_from(self, tag):
         self.tags.remove(tag)
-        self._log('Tag %s removed'%(tag.name))
+        self._log_link('tags', tag.name, False)
 
     def add_child(self, child):
         self.children.append(child)
-        self._log('Child %s added'%(child.name))
+        self._log_link('children', child.name, True)
 
     def remove_child(self, child):
         self.children.remove(child)
-        self._log('Child %s removed'%(child.name))
+        self._log_link('children', child.name, False)
 
     def to_data(self, item_href=None, tag_href=None):
         ''' Return a data representation of this Item.
             The vars attribute shows the origin of the variable.'''
-        def tag_length(tag):
-            return len(tag.name)
-        def vars_sort(var):
-            return var['key']
         data = {
             'name': self.name,
             'tags': [],
@@ -143,40 +429,24 @@ class Item(Base, VariableMixin, CompatMixin, LogMixin):
             if item_href:
                 child_data['href'] = item_href(child)
             data['children'].append(child_data)
-        vars = []
-        var_keys = {}
-        for tag in sorted(self.tags, key=tag_length):
-            for k,v in tag.variables.items():
-                var = {
-                    'key': k,
-                    'value': v,
-                    'tag': tag.name
-                }
+        tags = dict((tag.name, tag) for tag in self.tags)
+        resolved = self.get_stored_variables()
+        if resolved is None or not all(tag_name is None or tag_name in tags for k, v, tag_name in resolved):
+            resolved = VariableResolver().resolve_origins(self.tags, self.variables)
+        data['vars'] = []
+        for k, v, tag_name in resolved:
+            var = {'key': k, 'value': v}
+            if tag_name is not None:
+                var['tag'] = tag_name
                 if tag_href:
-                    var['href'] = tag_href(tag)
-                if k in var_keys:
-                    vars.remove(var_keys[k])
-                    var_keys[k] = var
-                else:
-                    var_keys[k] = var
-                vars.append(var)
-        for k, v in self.variables.items():
-            if k in var_keys:
-                vars.remove(var_keys[k])
-            vars.append({'key': k, 'value': v })
-        data['vars'] = sorted(vars, key=vars_sort)
+                    var['href'] = tag_href(tags[tag_name])
+            data['vars'].append(var)
         return data
 
     def update_from(self, data):
         ### normalize variables
-        if type(data.get('vars', {}))==list:
-            vars = {}
-            own_vars = [ property for property in data['vars'] if 'tag' not in property ]
-            for property in data['vars']:
-                vars[property['key']] = property['value']
-            for property in own_vars:
-                vars[property['key']] = property['value']
-            data['vars'] = vars
+        if 'vars' in data:
+            data['vars'] = variables_from_data(data['vars'])
 
         ### tags
         current_tags = [ tag.name for tag in self.tags ]
@@ -184,33 +454,36 @@ class Item(Base, VariableMixin, CompatMixin, LogMixin):
         tags_to_add = set(new_tags) - set(current_tags)
         tags_to_remove = set(current_tags) - set(new_tags)
 
-        for tag_name in tags_to_add:
-            tag = Tag.find(tag_name)
-            if not tag:
-                raise MelangeException("Tag '%s' not found"%(tag_name))
-            self.add_to(tag)
-
-        for tag_name in tags_to_remove:
-            tag = Tag.find(tag_name)
-            if tag:
-                self.remove_from(tag)
-
         ### children
         current_children = [ child.name for child in self.children ]
         new_children = [ child['name'] for child in data.get('children', []) ]
         children_to_add = set(new_children) - set(current_children)
         children_to_remove = set(current_children) -  set(new_children)
 
-        for child_name in children_to_add:
-            child = Item.find(child_name)
-            if not child:
-                raise MelangeException("Child '%s' not found"%(child_name))
-            self.add_child(child)
+        ### look up all names before changing anything
+        tags = Tag.find_by_names(tags_to_add)
+        children = Item.find_by_names(children_to_add)
+        errors = []
+        missing_tags = sorted(tags_to_add - set(tags))
+        if missing_tags:
+            errors.append("Tags not found: %s"%(', '.join(missing_tags)))
+        missing_children = sorted(children_to_add - set(children))
+        if missing_children:
+            errors.append("Children not found: %s"%(', '.join(missing_children)))
+        if errors:
+            raise MelangeException('; '.join(errors))
+
+        for tag in self.tags[:]:
+            if tag.name in tags_to_remove:
+                self.remove_from(tag)
+        for tag_name in sorted(tags_to_add):
+            self.add_to(tags[tag_name])
 
-        for child_name in children_to_remove:
-            child = Item.find(child_name)
-            if child:
+        for child in self.children[:]:
+            if child.name in children_to_remove:
                 self.remove_child(child)
+        for child_name in sorted(children_to_add):
+            self.add_child(children[child_name])
 
         ### variables
         current_variables = self.variables
@@ -236,14 +509,27 @@ class Tag(Base, VariableMixin, CompatMixin, LogMixin):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(), unique=True)
-    properties = Column(Text)
+    variable_owner = 'tag'
+    variable_rows = variables_relationship('Tag')
 
     def __init__(self, name):
         self.name = name
-        self._log('Tag %s created'%(self.name))
+        self._created()
     def __repr__(self):
         return "<Tag '%s'>"%(self.name)
 
+    def _created(self):
+        self._log('Tag %s created'%(self.name))
+
+    def _invalidate(self):
+        db_session.info.setdefault('stale_tags', set()).add(self)
+
+    def remove(self):
+        ### the membership is gone after the flush
+        for item in self.items:
+            item._invalidate()
+        super(Tag, self).remove()
+
     def to_data(self, item_href=None):
         data = {
             'name': self.name,
@@ -264,15 +550,16 @@ class Tag(Base, VariableMixin, CompatMixin, LogMixin):
         items_to_add = set(new_items) - set(current_items)
         items_to_remove = set(current_items) - set(new_items)
 
-        for item_name in items_to_add:
-            item = Item.find(item_name)
-            if not item:
-                raise MelangeException("Item '%s' not found"%(item_name))
-            item.add_to(self)
-        for item_name in items_to_remove:
-            item = Item.find(item_name)
-            if item:
-                item.remove_from(self)
+        ### one query for all items, with the tags add_to and remove_from need
+        items = Item.find_by_names(items_to_add | items_to_remove, selectinload(Item.tags))
+        missing_items = sorted(items_to_add - set(items))
+        if missing_items:
+            raise MelangeException("Items not found: %s"%(', '.join(missing_items)))
+
+        for item_name in sorted(items_to_remove):
+            items[item_name].remove_from(self)
+        for item_name in sorted(items_to_add):
+            items[item_name].add_to(self)
 
         ### variables
         current_variables = self.variables
@@ -288,6 +575,92 @@ class Tag(Base, VariableMixin, CompatMixin, LogMixin):
                 self.set_variable(k, v)
             ### existing variables are already checked
 
+for cls in [Item, Tag]:
+    event.listen(cls, 'expire', forget_parsed_variables)
+    event.listen(cls, 'refresh', forget_parsed_variables)
+
+@event.listens_for(Item.tags, 'append')
+@event.listens_for(Item.tags, 'remove')
+def membership_changed(item, tag, initiator):
+    ''' The stored variables of an item depend on its tags. The backref
+        makes tag.items changes arrive here as well.'''
+    item._invalidate()
+
+@event.listens_for(db_session, 'before_flush')
+def write_variables(session, flush_context, instances):
+    ''' Serialize the changed variables once per flush. '''
+    for obj in session.info.pop('unsaved_variables', set()):
+        if obj not in session.deleted:
+            obj._write_variables()
+
+@event.listens_for(db_session, 'before_commit')
+def write_change_sets(session):
+    ''' Write the gathered changes as one log entry per object. '''
+    change_sets = session.info.pop('change_sets', {})
+    date = datetime.utcnow()
+    rows = []
+    for (cls, name), change_set in change_sets.items():
+        data = change_set.to_data()
+        if data:
+            rows.append({
+                'name': name,
+                'date': date,
+                'message': ChangeSet.summary(data),
+                'changes': json.dumps(data),
+            })
+    if not rows:
+        return
+    if log_writer is None:
+        session.execute(Log.__table__.insert(), rows)
+    else:
+        session.info['unwritten_log'] = rows
+
+@event.listens_for(db_session, 'after_commit')
+def queue_change_sets(session):
+    ''' Hand the log entries of a committed transaction to the writer. '''
+    rows = session.info.pop('unwritten_log', None)
+    if rows:
+        log_writer.append(rows)
+
+@event.listens_for(db_session, 'after_commit')
+def invalidate_credentials(session):
+    ''' Forget the passwords that were cached while the users changed. '''
+    for name in session.info.pop('changed_users', set()):
+        credential_cache.invalidate(name)
+
+@event.listens_for(db_session, 'before_commit')
+def store_stale_variables(session):
+    ''' Recompute the resolved variables of all items affected by changes
+        in this transaction: changed items and all members of changed tags.'''
+    stale_items = session.info.pop('stale_items', set())
+    stale_tags = session.info.pop('stale_tags', set())
+    if not stale_items and not stale_tags:
+        return
+    session.flush()
+    item_ids = set(item.id for item in stale_items if item.id is not None)
+    tag_ids = [tag.id for tag in stale_tags if tag.id is not None]
+    if tag_ids:
+        members = session.query(items_to_tags.c.item_id).filter(items_to_tags.c.tag_id.in_(tag_ids))
+        item_ids.update(item_id for item_id, in members)
+    from melange.inventory import store_resolved_variables
+    store_resolved_variables(item_ids)
+
+def forget_changes(session):
+    ''' Drop what was gathered for a transaction that did not commit. '''
+    session.info.pop('stale_items', None)
+    session.info.pop('stale_tags', None)
+    session.info.pop('change_sets', None)
+    session.info.pop('unwritten_log', None)
+    session.info.pop('changed_users', None)
+    for obj in session.info.pop('unsaved_variables', set()):
+        forget_parsed_variables(obj)
+
+@event.listens_for(db_session, 'after_transaction_end')
+def forget_stale_variables(session, transaction):
+    ### a commit has already taken them, close and rollback have not
+    if transaction.parent is None:
+        forget_changes(session)
+
 class User(Base, CompatMixin, LogMixin):
     __tablename__  = 'users'
 
@@ -300,21 +673,78 @@ class User(Base, CompatMixin, LogMixin):
     def __repr__(self):
         return "<User('%s')>"%(self.name)
 
+    def _invalidate(self):
+        ### a request can cache the old password until the commit
+        credential_cache.invalidate(self.name)
+        db_session.info.setdefault('changed_users', set()).add(self.name)
+
     def set_password(self, passwd):
         self.hash = sha256_crypt.encrypt(passwd)
+        self._invalidate()
         self._log('Password set')
     password = property(None,set_password)
 
+    def remove(self):
+        self._invalidate()
+        super(User, self).remove()
+
     def authenticate(self, passwd):
         return sha256_crypt.verify(passwd, self.hash)
 
+    def add_token(self, description):
+        ''' Create an API token and return its value.
+            The value can not be retrieved afterwards.'''
+        value = secrets.token_urlsafe(32)
+        self.tokens.append(Token(value, description))
+        self._log("Token '%s' created"%(description))
+        return value
+
+    def remove_token(self, token):
+        self.tokens.remove(token)
+        self._log("Token '%s' revoked"%(token.description))
+
+class Token(Base):
+    ''' An API token. Only a SHA-256 digest of the value is stored: the
+        values are random, so a slow password hash adds nothing.'''
+    __tablename__ = 'tokens'
+
+    id = Column(Integer, primary_key=True)
+    user_name = Column(String, ForeignKey('users.name'), nullable=False)
+    digest = Column(String, nullable=False, unique=True)
+    description = Column(String, nullable=False)
+    created = Column(DateTime, nullable=False)
+    user = relationship('User', backref=backref('tokens', cascade='all, delete-orphan'))
+
+    def __init__(self, value, description):
+        self.digest = Token.hash(value)
+        self.description = description
+        self.created = datetime.utcnow()
+    def __repr__(self):
+        return "<Token('%s', '%s')>"%(self.user_name, self.description)
+
+    @staticmethod
+    def hash(value):
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def find_by_value(cls, value):
+        return cls.query.filter(cls.digest==Token.hash(value)).first()
+
 class Log(Base, CompatMixin):
     __tablename__ = 'log'
+    __table_args__ = (
+        ### keyset pagination, newest first
+        Index('ix_log_date_id', 'date', 'id'),
+        ### history of a single item or tag
+        Index('ix_log_name_date', 'name', 'date'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     date = Column(DateTime, nullable=False, index=True)
     message = Column(Text, nullable=False)
+    ### JSON data of a ChangeSet
+    changes = Column(Text)
 
     @classmethod
     def find_all(cls):
@@ -326,11 +756,61 @@ class Log(Base, CompatMixin):
             end = datetime.utcnow()
         return cls.query.filter(cls.date>=start, cls.date<=end).order_by(cls.date.desc()).all()
 
-    def __init__(self, name, message, date=None):
+    @classmethod
+    def find_page(cls, since=None, until=None, name=None, cursor=None, limit=LOG_PAGE_SIZE):
+        ''' Return up to limit entries from since up to until, newest first,
+            and the cursor of the next page or None.
+            The cursor is that of the last entry of the previous page.'''
+        query = cls.query
+        if since is not None:
+            query = query.filter(cls.date>=since)
+        if until is not None:
+            query = query.filter(cls.date<until)
+        if name is not None:
+            query = query.filter(cls.name==name)
+        if cursor is not None:
+            date, id = cls.parse_cursor(cursor)
+            query = query.filter(or_(cls.date<date, and_(cls.date==date, cls.id<id)))
+        entries = query.order_by(cls.date.desc(), cls.id.desc()).limit(limit+1).all()
+        if len(entries) > limit:
+            return entries[:limit], entries[limit-1].cursor()
+        return entries, None
+
+    def cursor(self):
+        return '%s_%d'%(self.date.strftime(LOG_CURSOR_FORMAT), self.id)
+
+    @staticmethod
+    def parse_cursor(cursor):
+        try:
+            date, id = cursor.split('_')
+            return datetime.strptime(date, LOG_CURSOR_FORMAT), int(id)
+        except ValueError:
+            raise MelangeException("Invalid cursor '%s'"%(cursor))
+
+    def get_changes(self):
+        if self.changes is None:
+            return None
+        with measure('json'):
+            return json.loads(self.changes)
+
+    def to_data(self):
+        return {
+            'name': self.name,
+            'date': self.date.isoformat(),
+            'message': self.message,
+            'changes': self.get_changes(),
+        }
+
+    def __init__(self, name, message, date=None, changes=None):
         if date is None:
             date = datetime.utcnow()
         self.name = name
         self.message = message
         self.date = date
+        if changes is not None:
+            self.changes = json.dumps(changes)
     def __repr__(self):
         return "<Log('%s', '%s', '%s')"%(self.name, self.message, self.date)
+
+### rows inserted later change what the log endpoints answer
+log_writer = create_log_writer(Log.__table__, bump_revision)
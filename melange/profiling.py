@@ -0,0 +1,188 @@
+# (c) 2013, Jeroen Hoekx <jeroen.hoekx@dsquare.be>
+#
+# This file is part of Melange.
+#
+# Melange is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Melange is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Melange.  If not, see <http://www.gnu.org/licenses/>.
+
+### Profiles single requests of the PROFILING_USERS, imported when PROFILING
+### is set. A request with an X-Melange-Profile header or a _profile
+### parameter of 'cpu' runs under cProfile, 'memory' also traces
+### allocations. The profiles are kept in PROFILING_DIR.
+
+import cProfile
+import io
+import os
+import pstats
+import re
+import secrets
+import threading
+import time
+import tracemalloc
+
+from datetime import datetime
+from functools import wraps
+
+from flask import abort, g, make_response, request
+
+from melange import app
+from melange.auth import request_user
+
+PROFILE_ID = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$')
+MODES = ['cpu', 'memory']
+
+### cProfile can not profile two threads at the same time
+profiling_lock = threading.Lock()
+
+
+class RequestProfile(object):
+
+    def __init__(self, mode):
+        self.id = '%s-%s'%(datetime.utcnow().strftime('%Y%m%dT%H%M%S'), secrets.token_hex(4))
+        self.mode = mode
+        self.profile = cProfile.Profile()
+        self.tracing = False
+        self.start = None
+
+    def enable(self):
+        if self.mode == 'memory' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        self.start = time.perf_counter()
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+        duration = time.perf_counter() - self.start
+        snapshot = None
+        if self.tracing:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        return duration, snapshot
+
+    def report(self, duration, snapshot):
+        ''' The top PROFILING_TOP functions and allocations as text. '''
+        top = app.config['PROFILING_TOP']
+        out = io.StringIO()
+        out.write('%s %s\n%s, %.1fms\n\n'%(request.method, request.full_path.rstrip('?'), self.id, duration * 1000))
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(top)
+        if snapshot is not None:
+            out.write('Allocations still held at the end of the request:\n')
+            for statistic in snapshot.statistics('lineno')[:top]:
+                out.write('%s\n'%(statistic))
+        return out.getvalue()
+
+    def save(self, duration, snapshot):
+        directory = app.config['PROFILING_DIR']
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.profile.dump_stats(os.path.join(directory, '%s.prof'%(self.id)))
+        with open(os.path.join(directory, '%s.txt'%(self.id)), 'w') as f:
+            f.write(self.report(duration, snapshot))
+        remove_old_profiles(directory, app.config['PROFILING_KEEP'])
+
+
+def list_profiles(directory):
+    ''' The ids of the stored profiles, newest first. '''
+    if not os.path.isdir(directory):
+        return []
+    ids = [filename[:-len('.txt')] for filename in os.listdir(directory) if filename.endswith('.txt')]
+    return sorted((id for id in ids if PROFILE_ID.match(id)), reverse=True)
+
+
+def remove_old_profiles(directory, keep):
+    for id in list_profiles(directory)[keep:]:
+        for extension in ['txt', 'prof']:
+            path = os.path.join(directory, '%s.%s'%(id, extension))
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def is_profiler(user):
+    return user is not None and user in app.config['PROFILING_USERS']
+
+
+@app.before_request
+def start_profile():
+    mode = request.headers.get('X-Melange-Profile') or request.args.get('_profile')
+    if mode not in MODES or not is_profiler(request_user()):
+        return
+    if not profiling_lock.acquire(False):
+        app.logger.warning('Not profiling %s, another request is being profiled', request.path)
+        return
+    g.profile = RequestProfile(mode)
+    g.profile.enable()
+
+
+@app.after_request
+def add_profile_id(response):
+    if 'profile' in g:
+        response.headers['X-Melange-Profile-Id'] = g.profile.id
+    return response
+
+
+@app.teardown_request
+def save_profile(exception=None):
+    ''' Runs after a streamed body is sent, so the profile covers it. '''
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    try:
+        duration, snapshot = profile.disable()
+        profile.save(duration, snapshot)
+    finally:
+        profiling_lock.release()
+
+
+def profiler_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        user = request_user()
+        if user is None:
+            response = make_response('Authentication Required', 401)
+            response.headers['WWW-Authenticate'] = 'Basic realm="Login required"'
+            return response
+        if not is_profiler(user):
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated
+
+
+@app.route('/profiles/', methods=['GET'])
+@profiler_required
+def show_profiles():
+    ids = list_profiles(app.config['PROFILING_DIR'])
+    response = make_response(''.join('%s\n'%(id) for id in ids), 200)
+    response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    return response
+
+
+@app.route('/profiles/<id>', methods=['GET'])
+@profiler_required
+def show_profile(id):
+    ''' The report as text, or the cProfile data for pstats with .prof. '''
+    id, extension = (id[:-len('.prof')], 'prof') if id.endswith('.prof') else (id, 'txt')
+    if not PROFILE_ID.match(id):
+        abort(404)
+    path = os.path.join(app.config['PROFILING_DIR'], '%s.%s'%(id, extension))
+    if not os.path.exists(path):
+        abort(404)
+    with open(path, 'rb') as f:
+        response = make_response(f.read(), 200)
+    if extension == 'prof':
+        response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Content-Disposition'] = 'attachment; filename=%s.prof'%(id)
+    else:
+        response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    return response
@@ -22,6 +22,7 @@ import re
 from flask import Blueprint, request, render_template
 
 from melange import Tag
+from melange.models import Variable, VariableResolver
 from melange.auth import session_auth
 
 reports = Blueprint('reports', __name__, template_folder='templates')
@@ -47,8 +48,13 @@ def check_items():
                 items[item.name] = item
 
     results = {}
+    resolver = VariableResolver()
+    owners = Variable.find_owners(variable_name)
     for item in items.values():
-        variables = item.get_all_variables()
+        ### skip items that can't have the variable without resolving
+        if item.id not in owners['item'] and not any(tag.id in owners['tag'] for tag in item.tags):
+            continue
+        variables = item.get_all_variables(resolver)
         if variable_name and variable_name in variables:
             if condition:
                 if not re.search(condition, variables[variable_name]):
@@ -0,0 +1,112 @@
+# (c) 2013, Jeroen Hoekx <jeroen.hoekx@dsquare.be>
+#
+# This file is part of Melange.
+#
+# Melange is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Melange is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Melange.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import json
+import os
+
+from datetime import datetime, time, timedelta
+
+from sqlalchemy import and_
+
+from melange.database import db_session
+from melange.models import CHUNK_SIZE, Log, archived_log, bump_revision
+
+
+def archive_path(archive_dir, day):
+    return os.path.join(archive_dir, day.strftime('%Y-%m'), day.strftime('%Y-%m-%d.ndjson.gz'))
+
+
+def archive_log(archive_dir, days, batch_size=CHUNK_SIZE):
+    ''' Move the log entries of the days that lie completely more than days
+        in the past to one gzip file of JSON lines per day, batch_size
+        entries at a time. Return the number of archived entries.
+        An interrupted run leaves entries in both places, readers skip
+        the duplicates.'''
+    cutoff = datetime.combine((datetime.utcnow() - timedelta(days=days)).date(), time())
+    archived = 0
+    while True:
+        entries = Log.query.filter(Log.date<cutoff)\
+            .order_by(Log.date, Log.id).limit(batch_size).all()
+        if not entries:
+            return archived
+        lines = {}
+        counts = {}
+        for entry in entries:
+            day = entry.date.date()
+            data = entry.to_data()
+            data['id'] = entry.id
+            lines.setdefault(day, []).append(json.dumps(data) + '\n')
+            counts[(day, entry.name)] = counts.get((day, entry.name), 0) + 1
+        for day, day_lines in lines.items():
+            path = archive_path(archive_dir, day)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            ### every run appends a gzip member, gzip reads them as one
+            with gzip.open(path, 'at') as f:
+                f.writelines(day_lines)
+        index_entries(counts)
+        db_session.execute(Log.__table__.delete().where(Log.id.in_([entry.id for entry in entries])))
+        bump_revision()
+        db_session.commit()
+        db_session.expunge_all()
+        archived += len(entries)
+
+
+def index_entries(counts):
+    ''' Add {(day, name): count} to the index of archived entries. '''
+    days = set(day for day, name in counts)
+    existing = set((day, name) for day, name in db_session.query(archived_log.c.day, archived_log.c.name)
+                   .filter(archived_log.c.day.in_(days)))
+    for (day, name), count in counts.items():
+        if (day, name) in existing:
+            db_session.execute(archived_log.update()
+                .where(and_(archived_log.c.day==day, archived_log.c.name==name))
+                .values(entries=archived_log.c.entries + count))
+        else:
+            db_session.execute(archived_log.insert().values(day=day, name=name, entries=count))
+
+
+def iter_archived_log(archive_dir, since=None, until=None, name=None):
+    ''' Yield the archived entries from since up to until, newest first.
+        The index limits the files that are read to the days with entries
+        of the name. Only one day is kept in memory.'''
+    query = db_session.query(archived_log.c.day).distinct()
+    if since is not None:
+        query = query.filter(archived_log.c.day>=since.date())
+    if until is not None:
+        query = query.filter(archived_log.c.day<=until.date())
+    if name is not None:
+        query = query.filter(archived_log.c.name==name)
+    for day, in query.order_by(archived_log.c.day.desc()).all():
+        path = archive_path(archive_dir, day)
+        if not os.path.exists(path):
+            continue
+        entries = {}
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                entry = json.loads(line)
+                date = datetime.fromisoformat(entry['date'])
+                if name is not None and entry['name'] != name:
+                    continue
+                if since is not None and date < since:
+                    continue
+                if until is not None and date >= until:
+                    continue
+                entries[entry['id']] = (date, entry)
+        for date, entry in sorted(entries.values(), key=lambda value: (value[0], value[1]['id']), reverse=True):
+            yield entry
@@ -0,0 +1,79 @@
+# (c) 2013, Jeroen Hoekx <jeroen.hoekx@dsquare.be>
+#
+# This file is part of Melange.
+#
+# Melange is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# Melange is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with Melange.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+
+from flask import Response, stream_with_context
+
+CHUNK_SIZE = 65536
+
+
+class JSONList(object):
+    ''' A JSON array whose elements are produced by an iterable. '''
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+
+class JSONObject(object):
+    ''' A JSON object whose members are produced by an iterable of
+        (key, value) pairs. '''
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+
+def iter_json(value):
+    ''' Encode value like json.dumps, one part at a time. JSONList and
+        JSONObject are expanded lazily, at any depth of other JSONList and
+        JSONObject values. All other values are encoded at once.'''
+    if isinstance(value, JSONList):
+        yield '['
+        for i, element in enumerate(value.iterable):
+            if i:
+                yield ', '
+            yield from iter_json(element)
+        yield ']'
+    elif isinstance(value, JSONObject):
+        yield '{'
+        for i, (key, element) in enumerate(value.pairs):
+            if i:
+                yield ', '
+            yield json.dumps(str(key))
+            yield ': '
+            yield from iter_json(element)
+        yield '}'
+    else:
+        yield json.dumps(value)
+
+
+def iter_chunks(parts, chunk_size=CHUNK_SIZE):
+    buffer = []
+    size = 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
+def stream_json(value):
+    ''' A streaming response with value encoded as JSON. '''
+    return Response(stream_with_context(iter_chunks(iter_json(value))), mimetype='application/json')
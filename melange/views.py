@@ -21,8 +21,12 @@ from datetime import datetime, timedelta
 from flask import (abort, g, make_response, redirect, render_template, request,
                    url_for)
 
-from melange import Item, Log, Tag, app
+from melange import Item, Log, MelangeException, Tag, app
 from melange.auth import session_auth
+from melange.database import retry_on_lock
+
+### log entries on the page of an item or tag
+RECENT_CHANGES = 10
 
 
 def update_variables(item, request):
@@ -100,6 +104,7 @@ def show_frontpage():
 
 @app.route("/tag/", methods=["GET", "POST"])
 @session_auth
+@retry_on_lock
 def list_tags():
     if request.method == "POST":
         tag_name = request.form["tag-name"]
@@ -113,6 +118,7 @@ def list_tags():
 
 @app.route("/tag/<name>/", methods=["GET", "POST"])
 @session_auth
+@retry_on_lock
 def show_tag(name):
     tag = Tag.find(name)
 
@@ -136,11 +142,14 @@ def show_tag(name):
             'value': v,
             'type': var_type,
         })
-    return render_template("tag.html", tag=tag, var_list=var_list)
+    changes, more_changes = Log.find_page(name=tag.name, limit=RECENT_CHANGES)
+    return render_template("tag.html", tag=tag, var_list=var_list,
+                           changes=changes, more_changes=more_changes)
 
 
 @app.route("/item/", methods=["GET", "POST"])
 @session_auth
+@retry_on_lock
 def list_items():
     if request.method == "POST":
         item_name = request.form["item-name"]
@@ -159,6 +168,7 @@ def list_items():
 
 @app.route("/item/<name>/", methods=["GET", "POST", "DELETE"])
 @session_auth
+@retry_on_lock
 def show_item(name):
     item = Item.find(name)
     if not item:
@@ -206,7 +216,9 @@ def show_item(name):
     available_tags = [tag.name for tag in Tag.find_all()
                       if tag.name not in tag_names]
 
-    return render_template('item.html', item=item, var_list=var_list, available_tags=available_tags)
+    changes, more_changes = Log.find_page(name=item.name, limit=RECENT_CHANGES)
+    return render_template('item.html', item=item, var_list=var_list, available_tags=available_tags,
+                           changes=changes, more_changes=more_changes)
 
 
 @app.route('/log/')
@@ -222,5 +234,19 @@ def show_log():
         start = datetime.strptime(start, '%Y-%m-%d')
     else:
         start = end - timedelta(weeks=3)
-    log = Log.find_range(start, end+timedelta(days=1))
-    return render_template('log.html', log=log, start=start, end=end)
+    name = request.args.get('log-name') or None
+    try:
+        log, cursor = Log.find_page(start, end+timedelta(days=1), name=name, cursor=request.args.get('log-next'))
+    except MelangeException:
+        abort(400)
+    next_url = None
+    if cursor:
+        args = {
+            'log-start': start.strftime('%Y-%m-%d'),
+            'log-end': end.strftime('%Y-%m-%d'),
+            'log-next': cursor,
+        }
+        if name:
+            args['log-name'] = name
+        next_url = url_for('show_log', **args)
+    return render_template('log.html', log=log, start=start, end=end, name=name, next_url=next_url)
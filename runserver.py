@@ -5,7 +5,12 @@ from optparse import OptionParser
 
 parser = OptionParser()
 parser.add_option('-i', '--initdb', default=None, action='store_true', dest='initdb')
+parser.add_option('-u', '--upgradedb', default=None, action='store_true', dest='upgradedb')
 parser.add_option('-d', '--dropdb', default=None, action='store_true', dest='dropdb')
+parser.add_option('-a', '--archive-log', default=None, action='store_true', dest='archive_log',
+                  help='move old log entries to the archive')
+parser.add_option('--retention-days', default=None, type='int', dest='retention_days',
+                  help='keep this many days of log in the database')
 options, args = parser.parse_args()
 
 if options.initdb:
@@ -16,6 +21,18 @@ if options.initdb:
     admin = User('admin')
     admin.password = 'admin'
     admin.save()
+elif options.upgradedb:
+    from melange.database import upgrade_db
+    print('Upgrading database')
+    upgrade_db()
+elif options.archive_log:
+    from melange import app
+    from melange.retention import archive_log
+    days = options.retention_days
+    if days is None:
+        days = app.config['LOG_RETENTION_DAYS']
+    print('Archiving log entries older than %d days' % (days))
+    print('Archived %d entries' % (archive_log(app.config['LOG_ARCHIVE_DIR'], days)))
 elif options.dropdb:
     from melange.database import drop_db
     print('Dropping database')
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # Export data in JSON format
 
-import json
 import sys
 from optparse import OptionParser
 from urllib.parse import urljoin
@@ -12,11 +11,13 @@ parser = OptionParser()
 parser.add_option('-s', '--src', default=None, dest='url')
 parser.add_option('-u', '--user', default=None, dest='user')
 parser.add_option('-p', '--password', default=None, dest='password')
+parser.add_option('-c', '--compact', default=None,
+                  action='store_true', dest='compact')
 options, args = parser.parse_args()
 
 
 def error(msg):
-    print >>sys.stderr, msg
+    print(msg, file=sys.stderr)
     sys.exit(1)
 
 
@@ -39,28 +40,13 @@ if r.status_code != 200:
 if not r.json:
     error('No JSON returned. Make sure you connect to the API.')
 
-tags = []
-item_urls = []
-items = []
+### the API redirects to the list of tags
+export_url = urljoin(r.url, '../export/')
+params = {'compact': '1'} if options.compact else {}
 
-for tag_ref in r.json():
-    tag_url = urljoin(options.url, tag_ref['href'])
-    tag_req = s.get(tag_url)
-    tag_data = tag_req.json()
-    for item_data in tag_data['items']:
-        item_url = urljoin(options.url, item_data['href'])
-        if item_url not in item_urls:
-            item_urls.append(item_url)
-    del tag_data['items']
-    tags.append(tag_data)
-
-for item_url in item_urls:
-    item_req = s.get(item_url)
-    item_data = item_req.json()
-    item_data['vars'] = [var for var in item_data['vars'] if 'tag' not in var]
-    items.append(item_data)
-
-print(json.dumps({
-    'tags': tags,
-    'items': items,
-}))
+r = s.get(export_url, params=params, stream=True)
+if r.status_code != 200:
+    error('Export failed: %s' % (r.status_code))
+for chunk in r.iter_content(chunk_size=65536, decode_unicode=True):
+    sys.stdout.write(chunk)
+print()
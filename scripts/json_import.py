@@ -20,7 +20,7 @@ options, args = parser.parse_args()
 
 
 def error(msg):
-    print >>sys.stderr, msg
+    print(msg, file=sys.stderr)
     sys.exit(1)
 
 
@@ -40,45 +40,15 @@ if r.status_code != 200:
 if not r.json:
     error('No JSON returned. Make sure you connect to the API.')
 
-entry_url = r.url
-existing_tags = {}
-for tag_ref in r.json():
-    existing_tags[tag_ref['name']] = urljoin(entry_url, tag_ref['href'])
+### the API redirects to the list of tags
+bulk_url = urljoin(r.url, '../bulk/')
+mode = 'merge' if options.merge else 'overwrite'
 
-json_text = ""
-json_text = sys.stdin.read()
+r = s.post(bulk_url, params={'mode': mode}, data=sys.stdin.read())
+if r.status_code >= 400:
+    try:
+        error('Import failed: %s' % (r.json()['error']))
+    except ValueError:
+        error('Import failed: %s' % (r.status_code))
 
-json_data = json.loads(json_text)
-
-for tag_data in json_data['tags']:
-    if tag_data['name'] in existing_tags:
-        r = s.put(existing_tags[tag_data['name']], data=json.dumps(tag_data))
-        if r.status_code >= 400:
-            error('Failed to update tag <%s>' % (tag_data['name']))
-    else:
-        r = s.post(entry_url, data=json.dumps(tag_data))
-        if r.status_code >= 400:
-            error('Failed to create tag <%s>' % (tag_data['name']))
-        existing_tags[tag_data['name']] = urljoin(
-            entry_url, r.headers['Content-Location'])
-
-children_cache = {}
-for item_data in json_data['items']:
-    first_tag_url = existing_tags[item_data['tags'][0]['name']]
-    children = item_data.get('children', None)
-    if children is not None:
-        del item_data['children']
-
-    r = s.post(first_tag_url, json.dumps(item_data))
-    if r.status_code >= 400:
-        error('Failed to create item <%s>' % (item_data['name']))
-    if children is not None:
-        children_cache[r.headers['Content-Location']] = children
-
-for url, children in children_cache.items():
-    r = s.get(urljoin(entry_url, url))
-    item_data = r.json()
-    item_data['children'] = children
-    r = s.put(urljoin(entry_url, url), json.dumps(item_data))
-    if r.status_code >= 400:
-        error('Failed to update children for <%s>' % (item_data['name']))
+print(json.dumps(r.json()))
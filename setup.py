@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name='Melange',
     version='1.0',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     package_data={
         '': [
             'templates/*',
@@ -1,13 +1,38 @@
 import base64
+import json
 import os
+import pstats
+import re
+import shutil
+import sqlite3
+import tempfile
 import unittest
 
+from datetime import datetime, timedelta
+
 from flask import url_for
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
 
 os.environ['MELANGE_CONFIG_MODULE'] = 'melange.config.TestingConfig'
 
 import melange
-from melange import Item, Tag, User, app, db_session
+import melange.profiling
+from melange import Item, Tag, Token, User, app, db_session
+from melange.inventory import Inventory
+from melange.config import Config
+from melange.models import LOG_PAGE_SIZE, data_revision
+from melange.retention import archive_log
+from melange.streaming import JSONList, JSONObject, iter_chunks, iter_json
+from melange.cache import credential_cache
+try:
+    import prometheus_client
+    import melange.metrics
+    from prometheus_client.parser import text_string_to_metric_families
+except ImportError:
+    prometheus_client = None
+from melange.database import (ReplicaSet, TimedQueuePool, engine, engine_options, replicas,
+                              retry_on_lock, set_sqlite_pragmas)
 
 
 def get_auth_headers():
@@ -17,6 +42,43 @@ def get_auth_headers():
     }
 
 
+def keep_only(groups, data):
+    ansible_data = {'_meta': {'hostvars': {}}}
+    keep = []
+    for keep_group in groups:
+        if keep_group in data:
+            keep.extend([host for host in data[keep_group]['hosts']])
+    for group, group_def in data.items():
+        if group == '_meta':
+            continue
+        hosts = group_def['hosts']
+        ansible_data[group] = {
+            'hosts': [host for host in hosts if host in keep]}
+    for item, vars in data['_meta']['hostvars'].items():
+        if item in keep:
+            ansible_data['_meta']['hostvars'][item] = vars
+    return ansible_data
+
+
+class QueryCounter(object):
+
+    def __init__(self):
+        self.count = 0
+        self.selects = 0
+
+    def __enter__(self):
+        event.listen(engine, 'before_cursor_execute', self.count_query)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(engine, 'before_cursor_execute', self.count_query)
+
+    def count_query(self, conn, cursor, statement, *args):
+        self.count += 1
+        if statement.lstrip().upper().startswith('SELECT'):
+            self.selects += 1
+
+
 class MelangeTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -52,6 +114,376 @@ class MelangeTestCase(unittest.TestCase):
     def delete_json(self, test_client, url):
         return test_client.get(url, headers=get_auth_headers())
 
+    def test_api_basic_auth_cache(self):
+        with app.test_client() as c:
+            rv = self.get_json(c, '/api/tag/')
+            assert rv.status_code == 200
+            assert credential_cache.verified('api', 'test')
+            user = User.find('api')
+            user.password = 'changed'
+            user.save()
+            rv = self.get_json(c, '/api/tag/')
+            assert rv.status_code == 401
+
+    def test_api_token_auth(self):
+        user = User.find('api')
+        value = user.add_token('ci')
+        user.save()
+        with app.test_client() as c:
+            rv = c.get('/api/tag/', headers={'Authorization': f'Bearer {value}'})
+            assert rv.status_code == 200
+            rv = c.get('/api/tag/', headers={'Authorization': 'Bearer invalid'})
+            assert rv.status_code == 401
+            user = User.find('api')
+            user.remove_token(user.tokens[0])
+            user.save()
+            rv = c.get('/api/tag/', headers={'Authorization': f'Bearer {value}'})
+            assert rv.status_code == 401
+
+    def test_create_token_in_ui(self):
+        with app.test_client() as c:
+            with c.session_transaction() as session:
+                session['username'] = 'api'
+            rv = c.post('/auth/user/api', data={'add-token': 'Create token', 'token-description': 'ci'})
+            assert rv.status_code == 200
+            token = Token.query.one()
+            assert token.user_name == 'api'
+            assert token.description == 'ci'
+            rv = c.post('/auth/user/api', data={'remove-token': 'Revoke', 'token-id': str(token.id)})
+            assert rv.status_code == 200
+            assert Token.query.count() == 0
+
+    def test_api_conditional_get(self):
+        Item('fireflash').save()
+        with app.test_client() as c:
+            rv = self.get_json(c, '/api/item/fireflash/')
+            etag = rv.headers['ETag']
+            headers = get_auth_headers()
+            headers['If-None-Match'] = etag
+            rv = c.get('/api/item/fireflash/', headers=headers)
+            assert rv.status_code == 304
+            assert rv.headers['ETag'] == etag
+            assert rv.get_data() == b''
+            rv = c.get('/api/ansible_inventory/', headers=headers)
+            assert rv.status_code == 304
+
+            data = self.get_json(c, '/api/item/fireflash/').get_json()
+            data['vars'].append({'key': 'hello', 'value': 'world'})
+            rv = self.put_json(c, '/api/item/fireflash/', data)
+            assert rv.status_code == 200
+            rv = c.get('/api/item/fireflash/', headers=headers)
+            assert rv.status_code == 200
+            assert rv.headers['ETag'] != etag
+
+    def test_no_log_after_failed_request(self):
+        Tag('linux').save()
+        with app.test_client() as c:
+            rv = self.post_json(c, '/api/tag/linux/', {'name': 'ghost', 'tags': [{'name': 'nope'}]})
+            assert rv.status_code == 400
+            rv = self.post_json(c, '/api/tag/', {'name': 'phantom', 'items': [{'name': 'nope'}]})
+            assert rv.status_code == 400
+            rv = self.post_json(c, '/api/tag/', {'name': 'server'})
+            assert rv.status_code == 201
+        names = [log.name for log in melange.Log.find_all()]
+        assert 'ghost' not in names
+        assert 'phantom' not in names
+        assert 'server' in names
+        assert Item.find('ghost') is None
+
+    def test_api_log(self):
+        for i in range(3):
+            Item('host-%d' % (i)).save()
+        with app.test_client() as c:
+            rv = self.get_json(c, '/api/log/?limit=2')
+            assert rv.status_code == 200
+            page = rv.get_json()
+            assert [entry['name'] for entry in page['entries']] == ['host-2', 'host-1']
+            rv = self.get_json(c, '/api/log/?limit=2&cursor=%s' % (page['next']))
+            page = rv.get_json()
+            assert [entry['name'] for entry in page['entries']] == ['host-0', 'api']
+            assert page['next'] is None
+
+            rv = self.get_json(c, '/api/log/?name=host-1&since=2000-01-01')
+            page = rv.get_json()
+            assert [entry['message'] for entry in page['entries']] == ['Item created']
+            assert page['next'] is None
+
+            rv = self.get_json(c, '/api/log/?until=2000-01-01')
+            assert rv.get_json() == {'entries': [], 'next': None}
+            assert self.get_json(c, '/api/log/?cursor=bad').status_code == 400
+            assert self.get_json(c, '/api/log/?since=yesterday').status_code == 400
+            assert self.get_json(c, '/api/log/?limit=0').status_code == 400
+
+    def test_api_history(self):
+        fireflash = Item('fireflash')
+        fireflash.save()
+        fireflash.set_variable('test', 'one')
+        fireflash.save()
+        Item('firefly').save()
+        laptop = Tag('laptop')
+        laptop.save()
+        with app.test_client() as c:
+            rv = self.get_json(c, '/api/item/fireflash/history/')
+            assert rv.status_code == 200
+            entries = rv.get_json()['entries']
+            assert [entry['message'] for entry in entries] == ['Variables added: test', 'Item created']
+            assert entries[0]['changes'] == {'vars': {'added': {'test': 'one'}, 'changed': {}, 'removed': []}}
+            rv = self.get_json(c, '/api/item/fireflash/history/?limit=1')
+            assert rv.get_json()['next'] is not None
+            rv = self.get_json(c, '/api/tag/laptop/history/')
+            assert [entry['message'] for entry in rv.get_json()['entries']] == ['Tag laptop created']
+            assert self.get_json(c, '/api/item/mole/history/').status_code == 404
+
+            with c.session_transaction() as session:
+                session['username'] = 'api'
+            rv = c.get('/item/fireflash/')
+            assert 'Variables added: test' in rv.get_data(as_text=True)
+
+    def test_api_archived_log(self):
+        archive_dir = tempfile.mkdtemp()
+        app.config['LOG_ARCHIVE_DIR'] = archive_dir
+        try:
+            db_session.add(melange.Log('fireflash', 'old', datetime.utcnow() - timedelta(days=400)))
+            db_session.commit()
+            archive_log(archive_dir, 365)
+            with app.test_client() as c:
+                rv = self.get_json(c, '/api/log/archive/?name=fireflash')
+                assert [entry['message'] for entry in rv.get_json()['entries']] == ['old']
+                rv = self.get_json(c, '/api/log/archive/?name=firefly')
+                assert rv.get_json() == {'entries': []}
+                since = (datetime.utcnow() - timedelta(days=401)).isoformat()
+                until = (datetime.utcnow() + timedelta(hours=2)).isoformat()
+                rv = self.get_json(c, '/api/log/archive/?since=%sZ&until=%s%%2B02:00' % (since, until))
+                assert rv.status_code == 200
+                assert [entry['message'] for entry in rv.get_json()['entries']] == ['old']
+                rv = self.get_json(c, '/api/log/?since=%sZ' % (since))
+                assert [entry['name'] for entry in rv.get_json()['entries']] == ['api']
+        finally:
+            app.config['LOG_ARCHIVE_DIR'] = Config.LOG_ARCHIVE_DIR
+            shutil.rmtree(archive_dir)
+
+    def test_log_page_in_ui(self):
+        for i in range(LOG_PAGE_SIZE + 1):
+            db_session.add(melange.Log('host-%d' % (i), 'test'))
+        db_session.commit()
+        with app.test_client() as c:
+            with c.session_transaction() as session:
+                session['username'] = 'api'
+            rv = c.get('/log/')
+            assert rv.status_code == 200
+            page = rv.get_data(as_text=True)
+            assert 'host-%d' % (LOG_PAGE_SIZE) in page
+            assert 'Older entries' in page
+
+            fireflash = Item('fireflash')
+            fireflash.set_variable('os', 'linux')
+            fireflash.save()
+            page = c.get('/log/').get_data(as_text=True)
+            assert 'os added: "linux"' in page
+            assert c.get('/log/?log-next=bad').status_code == 400
+
+    def test_api_stats(self):
+        with app.test_client() as c:
+            rv = self.get_json(c, '/api/stats/')
+            assert rv.status_code == 200
+            stats = rv.get_json()
+            assert stats['pid'] == os.getpid()
+            assert 'class' in stats['pool']
+            assert stats['auth_cache']['size'] >= 0
+
+    def test_request_stats(self):
+        Item('fireflash').save()
+        Tag('server').save()
+        Tag('laptop').save()
+        with app.test_client() as c:
+            rv = self.get_json(c, '/api/tag/')
+            timing = rv.headers['Server-Timing']
+            assert timing.startswith('db;dur=')
+            queries, rows = re.search(r'desc="(\d+) queries, (\d+) rows"', timing).groups()
+            assert int(queries) > 0
+            ### at least the two tags
+            assert int(rows) >= 2
+            assert 'json;dur=' in timing and 'template;dur=' in timing and 'total;dur=' in timing
+
+            app.config['ACCESS_LOG'] = True
+            app.config['SLOW_REQUEST_THRESHOLD'] = 0
+            try:
+                with self.assertLogs('melange', 'INFO') as logs:
+                    self.get_json(c, '/api/item/fireflash/')
+            finally:
+                app.config['ACCESS_LOG'] = False
+                app.config['SLOW_REQUEST_THRESHOLD'] = None
+            access = json.loads(logs.records[0].getMessage())
+            assert access['path'] == '/api/item/fireflash/'
+            assert access['status'] == 200
+            assert access['queries'] > 0
+            assert access['rows'] > 0
+            slow = logs.records[1].getMessage()
+            assert slow.startswith('Slow request GET /api/item/fireflash/')
+            assert 'FROM items' in slow
+
+    def test_profile_request(self):
+        Item('fireflash').save()
+        other = User('other')
+        other.password = 'test'
+        other.save()
+        other_headers = {'Authorization': 'Basic %s' % (base64.b64encode(b'other:test').decode())}
+        profiles = tempfile.mkdtemp()
+        app.config['PROFILING_DIR'] = profiles
+        app.config['PROFILING_USERS'] = ['api']
+        try:
+            with app.test_client() as c:
+                headers = dict(other_headers, **{'X-Melange-Profile': 'cpu'})
+                rv = c.get('/api/item/fireflash/', headers=headers)
+                assert rv.status_code == 200
+                assert 'X-Melange-Profile-Id' not in rv.headers
+                assert c.get('/profiles/', headers=other_headers).status_code == 403
+                assert c.get('/profiles/').status_code == 401
+
+                headers = dict(get_auth_headers(), **{'X-Melange-Profile': 'memory'})
+                rv = c.get('/api/item/fireflash/', headers=headers)
+                assert rv.status_code == 200
+                id = rv.headers['X-Melange-Profile-Id']
+                rv = c.get('/api/item/fireflash/?_profile=cpu', headers=get_auth_headers())
+                second_id = rv.headers['X-Melange-Profile-Id']
+                assert second_id != id
+
+                rv = self.get_json(c, '/profiles/')
+                assert set(rv.get_data(as_text=True).split()) == set([id, second_id])
+                report = self.get_json(c, '/profiles/%s' % (id)).get_data(as_text=True)
+                assert report.startswith('GET /api/item/fireflash/\n')
+                assert 'show_item' in report
+                assert 'Allocations still held' in report
+                rv = self.get_json(c, '/profiles/%s.prof' % (id))
+                path = os.path.join(profiles, 'download.prof')
+                with open(path, 'wb') as f:
+                    f.write(rv.get_data())
+                assert pstats.Stats(path).total_calls > 0
+                assert self.get_json(c, '/profiles/../config').status_code == 404
+        finally:
+            app.config['PROFILING_DIR'] = Config.PROFILING_DIR
+            app.config['PROFILING_USERS'] = Config.PROFILING_USERS
+            shutil.rmtree(profiles)
+
+    @unittest.skipUnless(prometheus_client, 'prometheus_client is not installed')
+    def test_metrics(self):
+        Item('fireflash').save()
+        labels = (('blueprint', 'melange_api'), ('method', 'GET'), ('rule', '/api/item/<name>/'))
+        ### the counters are shared by all tests
+        requests = prometheus_client.REGISTRY.get_sample_value('melange_requests_total',
+                                                               dict(labels, status='200')) or 0
+        with app.test_client() as c:
+            self.get_json(c, '/api/item/fireflash/')
+            assert c.get('/metrics').status_code == 401
+            rv = self.get_json(c, '/metrics')
+            assert rv.status_code == 200
+            samples = {}
+            for family in text_string_to_metric_families(rv.get_data(as_text=True)):
+                for sample in family.samples:
+                    samples[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+            assert samples[('melange_items', ())] == 1
+            assert samples[('melange_tags', ())] == 0
+            assert samples[('melange_requests_total', labels + (('status', '200'),))] == requests + 1
+            assert samples[('melange_request_duration_seconds_count', labels)] >= 1
+            assert samples[('melange_request_queries_count', (labels[0], labels[2]))] >= 1
+            assert samples[('melange_auth_verify_seconds_count', ())] >= 1
+            assert ('melange_cache_misses_total', (('cache', 'credentials'),)) in samples
+
+    def test_engine_options(self):
+        config = dict(Config.__dict__, DATABASE_URL='postgresql://melange@localhost/melange',
+                      DATABASE_STATEMENT_TIMEOUT=5000)
+        options = engine_options(config)
+        assert options['pool_size'] == Config.DATABASE_POOL_SIZE
+        assert options['pool_pre_ping'] is True
+        assert options['poolclass'] is TimedQueuePool
+        assert options['connect_args'] == {'options': '-c statement_timeout=5000'}
+        config['DATABASE_URL'] = 'sqlite:////var/lib/melange/melange.db'
+        assert 'pool_size' not in engine_options(config)
+
+        timed_engine = create_engine('sqlite://', poolclass=TimedQueuePool)
+        with timed_engine.connect():
+            pass
+        assert timed_engine.pool.checkouts == 1
+        assert timed_engine.pool.checkout_wait >= 0
+
+    def test_sqlite_pragmas(self):
+        path = tempfile.mkdtemp()
+        sqlite_engine = create_engine('sqlite:///%s' % (os.path.join(path, 'melange.db')))
+        event.listen(sqlite_engine, 'connect', set_sqlite_pragmas)
+        try:
+            with sqlite_engine.connect() as connection:
+                assert connection.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+                assert connection.execute(text('PRAGMA busy_timeout')).scalar() == 5000
+                assert connection.execute(text('PRAGMA synchronous')).scalar() == 1
+        finally:
+            sqlite_engine.dispose()
+            shutil.rmtree(path)
+
+    def test_retry_on_lock(self):
+        attempts = []
+
+        @retry_on_lock
+        def write(error):
+            attempts.append(error)
+            if len(attempts) < 3:
+                raise OperationalError('COMMIT', {}, sqlite3.OperationalError(error))
+            return 'done'
+        assert write('database is locked') == 'done'
+        assert len(attempts) == 3
+
+        attempts[:] = []
+        self.assertRaises(OperationalError, write, 'no such table: items')
+        assert len(attempts) == 1
+
+    def create_replica(self):
+        path = tempfile.mkdtemp()
+        replica = create_engine('sqlite:///%s' % (os.path.join(path, 'replica.db')))
+        melange.database.Base.metadata.create_all(bind=replica)
+        user = User.find('api')
+        with replica.begin() as connection:
+            connection.execute(User.__table__.insert().values(name=user.name, hash=user.hash))
+            connection.execute(Item.__table__.insert().values(name='replica-only'))
+            connection.execute(data_revision.insert().values(id=1, revision=1))
+        return path, replica
+
+    def test_replica_routing(self):
+        path, replica = self.create_replica()
+        replicas.engines = [replica]
+        try:
+            Tag('laptop').save()
+            with app.test_client() as c:
+                assert self.get_json(c, '/api/item/replica-only/').status_code == 200
+                assert self.get_json(c, '/api/tag/laptop/').status_code == 404
+                rv = self.post_json(c, '/api/tag/laptop/', {'name': 'fireflash'})
+                assert rv.status_code == 201
+            assert Item.find('fireflash') is not None
+            assert Item.find('replica-only') is None
+
+            ### reads after a write stay on the primary
+            db_session.info['replica'] = replica
+            assert Item.find('replica-only') is not None
+            Item('firefly').save()
+            assert Item.find('replica-only') is None
+            assert Item.find('firefly') is not None
+        finally:
+            db_session.info.pop('replica', None)
+            db_session.info.pop('wrote', None)
+            replicas.engines = []
+            replica.dispose()
+            shutil.rmtree(path)
+
+    def test_replica_health(self):
+        path, replica = self.create_replica()
+        missing = create_engine('sqlite:///%s' % (os.path.join(path, 'missing', 'replica.db')))
+        replica_set = ReplicaSet([missing, replica], 30)
+        try:
+            assert replica_set.choose() is replica
+            assert replica_set.choose() is replica
+            assert replica_set.healthy == {missing: False, replica: True}
+        finally:
+            replica.dispose()
+            shutil.rmtree(path)
+
     def test_api_create_tag(self):
         data = {
             'name': 'laptop'
@@ -284,6 +716,267 @@ class MelangeTestCase(unittest.TestCase):
                 '_meta': {'hostvars': {'fireflash': {}, 'mole': {}}}
             }
 
+    def create_fleet(self, start, end):
+        linux = Tag.find('linux') or Tag('linux')
+        linux.set_variable('test', 'linux')
+        laptop = Tag.find('laptop') or Tag('laptop')
+        laptop.set_variable('test', 'laptop')
+        laptop.set_variable('battery', True)
+        for i in range(start, end):
+            item = Item('host-%d' % (i))
+            item.add_to(linux)
+            if i % 2:
+                item.add_to(laptop)
+            if i % 3:
+                item.set_variable('test', 'host')
+            db_session.add(item)
+        db_session.commit()
+
+    def test_ansible_inventory_query_count(self):
+        self.create_fleet(0, 2)
+        credential_cache.clear()
+        with app.test_client() as c:
+            with QueryCounter() as small:
+                rv = self.get_json(c, '/api/ansible_inventory/')
+                assert rv.status_code == 200
+                rv.get_data()
+
+        self.create_fleet(2, 20)
+        credential_cache.clear()
+        with app.test_client() as c:
+            with QueryCounter() as large:
+                rv = self.get_json(c, '/api/ansible_inventory/')
+                assert rv.status_code == 200
+                rv.get_data()
+        assert small.count == large.count
+
+    def test_api_tag_members_query_count(self):
+        counts = []
+        for start, end in [(0, 2), (2, 22)]:
+            self.create_fleet(start, end)
+            name = 'group-%d' % (start)
+            Tag(name).save()
+            data = {
+                'name': name,
+                'items': [{'name': 'host-%d' % (i)} for i in range(start, end)],
+            }
+            credential_cache.clear()
+            with app.test_client() as c:
+                with QueryCounter() as counter:
+                    rv = self.put_json(c, '/api/tag/%s/' % (name), data)
+                    assert rv.status_code == 200
+            ### the log rows are written one by one
+            counts.append(counter.selects)
+            assert len(Tag.find(name).items) == end - start
+        assert counts[0] == counts[1]
+
+    def test_ansible_inventory_matches_to_data(self):
+        self.create_fleet(0, 10)
+        Item('unmanaged').save()
+        data = {}
+        for tag in Tag.find_all():
+            data[tag.name] = {'hosts': [host.name for host in tag.items]}
+        data['_meta'] = {'hostvars': {}}
+        for item in Item.find_all():
+            vars = {}
+            for var in item.to_data()['vars']:
+                vars[var['key']] = var['value']
+            data['_meta']['hostvars'][item.name] = vars
+        expected = json.dumps(keep_only(['linux', 'ansible-managed'], data))
+
+        with app.test_client() as c:
+            rv = self.get_json(c, '/api/ansible_inventory/')
+            assert rv.get_data(as_text=True) == expected
+
+    def test_bulk_import(self):
+        path = os.path.join(os.path.dirname(__file__), '..', 'examples', 'example-data.json')
+        with open(path) as f:
+            data = json.load(f)
+        data['items'].append({
+            'name': 'rack-1',
+            'tags': [],
+            'children': [{'name': 'host-a'}, {'name': 'host-b'}],
+            'vars': [{'key': 'location', 'value': 'dc-1'}],
+        })
+        with app.test_client() as c:
+            rv = self.post_json(c, '/api/bulk/', data)
+            assert rv.status_code == 200
+            summary = rv.get_json()
+        assert summary['tags'] == {'created': 4, 'updated': 0}
+        assert summary['items'] == {'created': 4, 'updated': 0}
+        assert summary['memberships'] == {'added': 9, 'removed': 0}
+        assert summary['children'] == {'added': 2, 'removed': 0}
+        host_c = Item.find('host-c')
+        assert sorted(tag.name for tag in host_c.tags) == ['dc-1', 'staging', 'tomcat']
+        assert host_c.variables == {'java_version': '7'}
+        assert host_c.get_all_variables()['gateway'] == '192.168.122.2'
+        assert host_c.get_stored_variables() is not None
+        assert [child.name for child in Item.find('rack-1').children] == ['host-a', 'host-b']
+        assert Item.find('rack-1').variables == {'location': 'dc-1'}
+
+    def test_bulk_import_modes(self):
+        self.test_bulk_import()
+        data = {
+            'tags': [{'name': 'tomcat', 'vars': {'tomcat_version': '8'}}],
+            'items': [{'name': 'host-c', 'tags': [{'name': 'tomcat'}], 'vars': {'ip': '10.0.0.3'}}],
+        }
+        with app.test_client() as c:
+            rv = c.post('/api/bulk/?mode=merge', headers=get_auth_headers(), json=data)
+            assert rv.status_code == 200
+            host_c = Item.find('host-c')
+            assert len(host_c.tags) == 3
+            assert host_c.variables == {'java_version': '7', 'ip': '10.0.0.3'}
+            assert Tag.find('tomcat').variables == {'java_version': '6', 'tomcat_version': '8'}
+
+            rv = self.post_json(c, '/api/bulk/', data)
+            assert rv.status_code == 200
+            assert rv.get_json()['memberships'] == {'added': 0, 'removed': 2}
+            host_c = Item.find('host-c')
+            assert [tag.name for tag in host_c.tags] == ['tomcat']
+            assert host_c.variables == {'ip': '10.0.0.3'}
+            assert Tag.find('tomcat').variables == {'tomcat_version': '8'}
+
+    def test_bulk_import_merge_inherits_kept_tags(self):
+        linux = Tag('linux')
+        linux.set_variable('x', 1)
+        host = Item('h')
+        host.add_to(linux)
+        host.save()
+        data = {
+            'tags': [{'name': 'web', 'vars': {'x': 2}}],
+            'items': [{'name': 'h', 'tags': [{'name': 'web'}], 'vars': {'x': 1, 'y': 2}}],
+        }
+        with app.test_client() as c:
+            rv = c.post('/api/bulk/?mode=merge', headers=get_auth_headers(), json=data)
+            assert rv.status_code == 200
+        host = Item.find('h')
+        assert sorted(tag.name for tag in host.tags) == ['linux', 'web']
+        assert host.variables == {'y': 2}
+
+    def test_bulk_import_malformed(self):
+        documents = [
+            [{'name': 'linux'}],
+            {'tags': {'name': 'linux'}},
+            {'items': ['fireflash']},
+            {'tags': [{'name': 'linux', 'vars': 'x'}]},
+            {'tags': [{'name': 'linux', 'vars': ['x']}]},
+            {'items': [{'name': 'fireflash', 'tags': 'linux'}]},
+            {'items': [{'name': 'fireflash', 'children': [{}]}]},
+        ]
+        with app.test_client() as c:
+            for data in documents:
+                rv = self.post_json(c, '/api/bulk/', data)
+                assert rv.status_code == 400, data
+                assert 'error' in rv.get_json()
+        assert Tag.find('linux') is None
+
+    def test_bulk_import_missing_tag(self):
+        data = {
+            'tags': [{'name': 'linux', 'vars': {}}],
+            'items': [{'name': 'fireflash', 'tags': [{'name': 'linux'}, {'name': 'laptop'}]}],
+        }
+        with app.test_client() as c:
+            rv = self.post_json(c, '/api/bulk/', data)
+            assert rv.status_code == 400
+            assert 'laptop' in rv.get_json()['error']
+        assert Tag.find('linux') is None
+        assert Item.find('fireflash') is None
+
+    def test_bulk_import_query_count(self):
+        def fleet(prefix, count, version):
+            items = [{
+                'name': '%s-%d' % (prefix, i),
+                'tags': [{'name': prefix}],
+                'vars': {'ip': '10.0.0.%d' % (i), 'version': version, 'role-%d' % (version): True},
+            } for i in range(count)]
+            items[0]['children'] = [{'name': item['name']} for item in items[1:]]
+            return {'tags': [{'name': prefix, 'vars': {'version': version}}], 'items': items}
+
+        counts = []
+        for prefix, count in [('small', 2), ('large', 20)]:
+            for version in [1, 2]:
+                credential_cache.clear()
+                with app.test_client() as c:
+                    with QueryCounter() as counter:
+                        rv = self.post_json(c, '/api/bulk/', fleet(prefix, count, version))
+                        assert rv.status_code == 200
+                counts.append(counter.count)
+            assert Item.find('%s-1' % (prefix)).variables == {'ip': '10.0.0.1', 'role-2': True}
+        assert counts[:2] == counts[2:]
+
+    def test_export(self):
+        self.test_bulk_import()
+        Item('untagged').save()
+        with app.test_client() as c:
+            tags = []
+            item_urls = []
+            items = []
+            for tag_ref in self.get_json(c, '/api/tag/').get_json():
+                tag_data = self.get_json(c, tag_ref['href']).get_json()
+                for item_data in tag_data['items']:
+                    if item_data['href'] not in item_urls:
+                        item_urls.append(item_data['href'])
+                del tag_data['items']
+                tags.append(tag_data)
+            for item_url in item_urls:
+                item_data = self.get_json(c, item_url).get_json()
+                item_data['vars'] = [var for var in item_data['vars'] if 'tag' not in var]
+                items.append(item_data)
+            expected = json.dumps({'tags': tags, 'items': items})
+
+            rv = self.get_json(c, '/api/export/')
+            assert rv.status_code == 200
+            assert rv.get_data(as_text=True) == expected
+
+            rv = self.get_json(c, '/api/export/?compact=1')
+            data = rv.get_json()
+            assert len(data['items']) == 3
+            assert 'href' not in data['items'][0]['tags'][0]
+            rv = self.post_json(c, '/api/bulk/', data)
+            assert rv.status_code == 200
+            assert rv.get_json()['variables'] == {'set': 0, 'removed': 0}
+
+    def test_tag_items(self):
+        self.create_fleet(0, 10)
+        with app.test_request_context():
+            def item_url(item):
+                return url_for('melange_api.show_item', name=item.name)
+            tags = [tag.to_data(item_href=item_url) for tag in Tag.find_all()]
+            for tag in tags:
+                tag['href'] = url_for('melange_api.show_tag', name=tag['name'])
+            expected = json.dumps(tags)
+        with app.test_client() as c:
+            rv = self.get_json(c, '/api/tag_items/')
+            assert rv.status_code == 200
+            assert rv.get_data(as_text=True) == expected
+
+    def test_inventory_batches(self):
+        self.create_fleet(0, 10)
+        inventory = Inventory.load()
+        names = []
+        for batch in Inventory.load_batches(3):
+            assert len(batch.items) <= 3
+            for item_id, item_name in batch.items.items():
+                names.append(item_name)
+                assert batch.get_all_variables(item_id) == inventory.get_all_variables(item_id)
+        assert names == list(inventory.items.values())
+
+
+class StreamingTestCase(unittest.TestCase):
+
+    def test_iter_json(self):
+        data = {'a': [1, {'b': None}], 'c': 'd', 'e': []}
+        value = JSONObject([
+            ('a', JSONList(iter([1, JSONObject([('b', None)])]))),
+            ('c', 'd'),
+            ('e', JSONList([])),
+        ])
+        assert ''.join(iter_json(value)) == json.dumps(data)
+
+    def test_iter_chunks(self):
+        chunks = list(iter_chunks(['ab', 'cd', 'e'], chunk_size=3))
+        assert chunks == ['abcd', 'e']
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,93 @@
+import os
+import time
+import unittest
+
+os.environ['MELANGE_CONFIG_MODULE'] = 'melange.config.TestingConfig'
+
+import melange
+from melange import User
+from melange.cache import CredentialCache, TTLCache, credential_cache
+
+
+class TTLCacheTestCase(unittest.TestCase):
+
+    def test_lru(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1}
+
+    def test_ttl(self):
+        cache = TTLCache(2, 0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        assert cache.get('a') is None
+        assert cache.stats()['size'] == 0
+
+    def test_disabled(self):
+        cache = TTLCache(0, 60)
+        cache.set('a', 1)
+        assert cache.get('a') is None
+
+
+class CredentialCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        melange.database.drop_db()
+        melange.database.init_db()
+        credential_cache.clear()
+
+    def test_credentials(self):
+        cache = CredentialCache(10, 60)
+        generation = cache.generation
+        cache.add('api', 'test', generation)
+        assert cache.verified('api', 'test')
+        assert not cache.verified('api', 'other')
+        assert not cache.verified('other', 'test')
+        assert b'test' not in b''.join(cache.entries.keys())
+
+    def test_invalidation_during_verification(self):
+        cache = CredentialCache(10, 60)
+        generation = cache.generation
+        cache.invalidate('api')
+        cache.add('api', 'test', generation)
+        assert not cache.verified('api', 'test')
+
+    def test_invalidate_on_password_change(self):
+        user = User('api')
+        user.password = 'test'
+        user.save()
+        credential_cache.add('api', 'test', credential_cache.generation)
+        credential_cache.add('admin', 'admin', credential_cache.generation)
+        user.password = 'changed'
+        user.save()
+        assert not credential_cache.verified('api', 'test')
+        assert credential_cache.verified('admin', 'admin')
+
+    def test_invalidate_after_commit(self):
+        user = User('api')
+        user.password = 'test'
+        user.save()
+        user.password = 'changed'
+        ### a request that still reads the old hash
+        credential_cache.add('api', 'test', credential_cache.generation)
+        assert credential_cache.verified('api', 'test')
+        user.save()
+        assert not credential_cache.verified('api', 'test')
+
+    def test_invalidate_on_remove(self):
+        user = User('api')
+        user.password = 'test'
+        user.save()
+        credential_cache.add('api', 'test', credential_cache.generation)
+        user.remove()
+        assert not credential_cache.verified('api', 'test')
+
+
+if __name__ == '__main__':
+    unittest.main()
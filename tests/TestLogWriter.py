@@ -0,0 +1,112 @@
+import base64
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from datetime import datetime
+
+os.environ['MELANGE_CONFIG_MODULE'] = 'melange.config.TestingConfig'
+
+from sqlalchemy import create_engine, select
+
+import melange
+import melange.models
+from melange import Item, Log, User, app
+from melange.logwriter import AsyncLogWriter
+
+
+def row(message):
+    return {'name': 'fireflash', 'date': datetime.utcnow(), 'message': message, 'changes': None}
+
+
+class AsyncLogWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.wal_dir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///%s' % (os.path.join(self.wal_dir, 'log.db')))
+        Log.__table__.create(bind=self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.wal_dir)
+
+    def messages(self):
+        with self.engine.connect() as connection:
+            query = select(Log.__table__.c.message).order_by(Log.__table__.c.id)
+            return [message for message, in connection.execute(query)]
+
+    def test_write(self):
+        writer = AsyncLogWriter(Log.__table__, self.wal_dir, interval=3600, bind=self.engine)
+        writer.append([row('one'), row('two')])
+        assert os.path.exists(writer.wal_path())
+        assert self.messages() == []
+        writer.flush()
+        assert self.messages() == ['one', 'two']
+        assert not os.path.exists(writer.wal_path())
+        writer.append([row('three')])
+        writer.stop()
+        assert self.messages() == ['one', 'two', 'three']
+        assert os.listdir(self.wal_dir) == ['log.db']
+
+    def test_replay(self):
+        ### the pid of a process that is gone
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        with open(os.path.join(self.wal_dir, '%d.wal.1' % (process.pid)), 'w') as f:
+            f.write(json.dumps(dict(row('one'), date=datetime.utcnow().isoformat())) + '\n')
+        with open(os.path.join(self.wal_dir, '%d.wal' % (process.pid)), 'w') as f:
+            f.write(json.dumps(dict(row('two'), date=datetime.utcnow().isoformat())) + '\n')
+            f.write('{"name": "incompl')
+        writer = AsyncLogWriter(Log.__table__, self.wal_dir, interval=3600, bind=self.engine)
+        writer.start()
+        assert self.messages() == ['one', 'two']
+        writer.stop()
+        assert os.listdir(self.wal_dir) == ['log.db']
+
+
+class AsyncLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        melange.database.drop_db()
+        melange.database.init_db()
+        self.writer = AsyncLogWriter(Log.__table__, interval=3600, on_insert=melange.models.bump_revision)
+        melange.models.log_writer = self.writer
+
+    def tearDown(self):
+        melange.models.log_writer = None
+        self.writer.stop()
+
+    def test_log_after_commit(self):
+        Item('fireflash').save()
+        assert Log.query.count() == 0
+        self.writer.flush()
+        assert [log.message for log in Log.find_all()] == ['Item created']
+
+    def test_no_log_after_rollback(self):
+        Item('fireflash')
+        melange.db_session.rollback()
+        self.writer.flush()
+        assert Log.query.count() == 0
+
+    def test_log_changes_revision(self):
+        user = User('api')
+        user.password = 'test'
+        user.save()
+        Item('fireflash').save()
+        headers = {'Authorization': 'Basic %s' % (base64.b64encode(b'api:test').decode())}
+        with app.test_client() as c:
+            rv = c.get('/api/item/fireflash/history/', headers=headers)
+            assert rv.get_json()['entries'] == []
+            headers['If-None-Match'] = rv.headers['ETag']
+            self.writer.flush()
+            rv = c.get('/api/item/fireflash/history/', headers=headers)
+            assert rv.status_code == 200
+            assert [entry['message'] for entry in rv.get_json()['entries']] == ['Item created']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 import unittest
 
 from datetime import datetime, timedelta
@@ -6,7 +8,11 @@ from datetime import datetime, timedelta
 os.environ['MELANGE_CONFIG_MODULE'] = 'melange.config.TestingConfig'
 
 import melange
-from melange import db_session, Item, Tag, User, Log
+from melange import db_session, Item, Tag, User, Log, MelangeException
+from melange.database import migrate_properties
+from melange.models import Variable, VariableResolver, archived_log, resolved_variables
+from melange.retention import archive_log, archive_path, iter_archived_log
+from sqlalchemy import text
 
 class MelangeTestCase(unittest.TestCase):
 
@@ -89,6 +95,64 @@ class MelangeTestCase(unittest.TestCase):
 
         assert 'hello' not in item.variables
 
+    def test_variable_rows(self):
+        self.create_simple_setup()
+        item = Item.find('firefly')
+        item.set_variable('hello', 'world')
+        item.set_variable('mylist', ['a', 'b'])
+        item.save()
+        tag = Tag.find('laptop')
+        tag.set_variable('hello', 'laptop')
+        tag.save()
+
+        item.set_variable('hello', 'again')
+        item.save()
+        rows = Variable.query.filter(Variable.owner_type=='item').order_by(Variable.id).all()
+        assert [(row.owner_id, row.key, row.value) for row in rows] == [
+            (item.id, 'hello', '"again"'), (item.id, 'mylist', '["a", "b"]')]
+        assert list(item.variables) == ['hello', 'mylist']
+        assert Variable.find_owners('hello') == {'item': set([item.id]), 'tag': set([tag.id])}
+
+        item.remove()
+        assert Variable.query.filter(Variable.owner_type=='item').count() == 0
+        assert Tag.find('laptop').variables == {'hello': 'laptop'}
+
+    def test_variables_written_at_flush(self):
+        self.create_simple_setup()
+        item = Item.find('firefly')
+        for i in range(50):
+            item.set_variable('key%d'%(i), i)
+        item.remove_variable('key0')
+        item.set_variable('key0', 'again')
+        assert len(item.variable_rows) == 0
+        assert item.variables['key0'] == 'again'
+        item.save()
+
+        item = Item.find('firefly')
+        assert len(item.variable_rows) == 50
+        assert item.variable_rows['key0'].value == '"again"'
+        assert list(item.variables)[-2:] == ['key49', 'key0']
+
+        item.set_variable('key1', 'changed')
+        db_session.rollback()
+        assert Item.find('firefly').variables['key1'] == 1
+
+    def test_migrate_properties(self):
+        self.create_simple_setup()
+        db_session.execute(text('ALTER TABLE items ADD COLUMN properties TEXT'))
+        db_session.execute(text('ALTER TABLE tags ADD COLUMN properties TEXT'))
+        db_session.execute(text('''UPDATE items SET properties = '{"hello": "world", "mylist": ["a"]}' '''))
+        db_session.execute(text('''UPDATE tags SET properties = '{}' '''))
+        migrate_properties()
+        db_session.commit()
+        db_session.expire_all()
+
+        item = Item.find('firefly')
+        assert item.variables == {'hello': 'world', 'mylist': ['a']}
+        assert Tag.find('laptop').variables == {}
+        migrate_properties()
+        assert Item.find('firefly').variables == {'hello': 'world', 'mylist': ['a']}
+
     def test_tag_variable(self):
         self.create_simple_setup()
 
@@ -148,6 +212,36 @@ class MelangeTestCase(unittest.TestCase):
         assert i3.children == [i1, i2]
         assert i1.parents == [i3]
 
+    def test_update_from_missing_names(self):
+        self.create_simple_setup()
+        item = Item.find('firefly')
+        data = {
+            'name': 'firefly',
+            'tags': [{'name': 'laptop'}, {'name': 'linux'}, {'name': 'desktop'}],
+            'children': [{'name': 'home'}],
+        }
+        try:
+            item.update_from(data)
+            assert False
+        except MelangeException as e:
+            assert str(e) == 'Tags not found: desktop, linux; Children not found: home'
+        assert item.tags == []
+
+        tag = Tag.find('laptop')
+        try:
+            tag.update_from({'name': 'laptop', 'items': [{'name': 'firefly'}, {'name': 'home'}]})
+            assert False
+        except MelangeException as e:
+            assert str(e) == 'Items not found: home'
+        assert tag.items == []
+
+        tag.update_from({'name': 'laptop', 'items': [{'name': 'firefly'}]})
+        tag.save()
+        assert [tag.name for tag in Item.find('firefly').tags] == ['laptop']
+        tag.update_from({'name': 'laptop', 'items': []})
+        tag.save()
+        assert Item.find('firefly').tags == []
+
     def test_data_variable_in_multiple_tags(self):
         item = Item('firefly')
         item.set_variable('hello', 'firefly')
@@ -164,6 +258,126 @@ class MelangeTestCase(unittest.TestCase):
         assert len(hello) == 1
         assert hello[0] == 'firefly'
 
+    def test_data_variable_origins(self):
+        item = Item('firefly')
+        item.set_variable('b', 'firefly')
+        linux = Tag('linux')
+        linux.set_variable('a', 'linux')
+        linux.set_variable('c', 'linux')
+        laptop = Tag('laptop')
+        laptop.set_variable('b', 'laptop')
+        laptop.set_variable('c', 'laptop')
+        item.add_to(laptop)
+        item.add_to(linux)
+
+        def tag_href(tag):
+            return '/tag/%s/' % (tag.name)
+        assert item.to_data(tag_href=tag_href)['vars'] == [
+            {'key': 'a', 'value': 'linux', 'tag': 'linux', 'href': '/tag/linux/'},
+            {'key': 'b', 'value': 'firefly'},
+            {'key': 'c', 'value': 'laptop', 'tag': 'laptop', 'href': '/tag/laptop/'},
+        ]
+
+    def test_resolver_shares_tag_layers(self):
+        laptop = Tag('laptop')
+        laptop.set_variable('hello', 'laptop')
+        laptop.set_variable('os', 'linux')
+        linux = Tag('linux')
+        linux.set_variable('hello', 'linux')
+        firefly = Item('firefly')
+        firefly.add_to(laptop)
+        firefly.add_to(linux)
+        fireflash = Item('fireflash')
+        fireflash.add_to(linux)
+        fireflash.add_to(laptop)
+        fireflash.set_variable('hello', 'fireflash')
+        db_session.add(firefly)
+        db_session.add(fireflash)
+        db_session.commit()
+
+        resolver = VariableResolver()
+        assert firefly.get_all_variables(resolver) == {'hello': 'laptop', 'os': 'linux'}
+        assert fireflash.get_all_variables(resolver) == {'hello': 'fireflash', 'os': 'linux'}
+        assert len(resolver.layers) == 1
+        assert firefly.get_all_variables(resolver) == firefly.get_all_variables()
+
+    def create_stored_setup(self):
+        laptop = Tag('laptop')
+        laptop.set_variable('hello', 'laptop')
+        firefly = Item('firefly')
+        firefly.set_variable('os', 'linux')
+        firefly.add_to(laptop)
+        fireflash = Item('fireflash')
+        fireflash.set_variable('hello', 'fireflash')
+        db_session.add(firefly)
+        db_session.add(fireflash)
+        db_session.commit()
+        return laptop, firefly, fireflash
+
+    def test_stored_variables(self):
+        laptop, firefly, fireflash = self.create_stored_setup()
+        assert firefly.get_stored_variables() == [['hello', 'laptop', 'laptop'], ['os', 'linux', None]]
+        assert fireflash.get_stored_variables() == [['hello', 'fireflash', None]]
+
+    def test_stored_variables_on_tag_variable(self):
+        laptop, firefly, fireflash = self.create_stored_setup()
+        laptop.set_variable('hello', 'world')
+        assert firefly.get_stored_variables() is None
+        laptop.save()
+        assert firefly.get_stored_variables() == [['hello', 'world', 'laptop'], ['os', 'linux', None]]
+        assert fireflash.get_stored_variables() == [['hello', 'fireflash', None]]
+
+    def test_stored_variables_on_membership(self):
+        laptop, firefly, fireflash = self.create_stored_setup()
+        firefly.remove_from(laptop)
+        fireflash.add_to(laptop)
+        db_session.commit()
+        assert firefly.get_stored_variables() == [['os', 'linux', None]]
+        assert fireflash.get_stored_variables() == [['hello', 'fireflash', None]]
+        fireflash.remove_variable('hello')
+        fireflash.save()
+        assert fireflash.get_stored_variables() == [['hello', 'laptop', 'laptop']]
+
+    def test_stored_variables_on_collection_membership(self):
+        laptop, firefly, fireflash = self.create_stored_setup()
+        linux = Tag('linux')
+        linux.set_variable('kernel', '3.10')
+        linux.save()
+        linux.items.append(fireflash)
+        laptop.items.remove(firefly)
+        db_session.commit()
+        assert firefly.get_stored_variables() == [['os', 'linux', None]]
+        assert fireflash.get_stored_variables() == [['hello', 'fireflash', None], ['kernel', '3.10', 'linux']]
+        firefly.tags.append(linux)
+        db_session.commit()
+        assert firefly.get_stored_variables() == [['kernel', '3.10', 'linux'], ['os', 'linux', None]]
+
+    def test_stored_variables_on_tag_remove(self):
+        laptop, firefly, fireflash = self.create_stored_setup()
+        laptop.remove()
+        assert firefly.get_stored_variables() == [['os', 'linux', None]]
+
+    def test_stored_variables_on_item_remove(self):
+        laptop, firefly, fireflash = self.create_stored_setup()
+        db_session.commit()
+        db_session.execute(text('PRAGMA foreign_keys = ON'))
+        try:
+            firefly.remove()
+            assert db_session.query(resolved_variables).filter(resolved_variables.c.item_id==firefly.id).count() == 0
+            assert fireflash.get_stored_variables() == [['hello', 'fireflash', None]]
+        finally:
+            db_session.rollback()
+            db_session.execute(text('PRAGMA foreign_keys = OFF'))
+            db_session.commit()
+
+    def test_stored_variables_to_data(self):
+        laptop, firefly, fireflash = self.create_stored_setup()
+        stored = firefly.to_data()
+        db_session.info['stale_items'] = set([firefly])
+        assert firefly.get_stored_variables() is None
+        assert firefly.to_data() == stored
+        db_session.rollback()
+
 class MelangeUserTestCase(unittest.TestCase):
     def setUp(self):
         melange.database.drop_db()
@@ -217,6 +431,27 @@ class MelangeLogTestCase(unittest.TestCase):
         assert len(logs)==1
         assert logs[0].message == 'test1'
 
+    def test_log_pages(self):
+        now = datetime.utcnow()
+        for i in range(5):
+            db_session.add(Log('fireflash', 'test%d'%(i), now - timedelta(hours=i)))
+        ### same date, told apart by id
+        db_session.add(Log('firefly', 'test5', now - timedelta(hours=4)))
+        db_session.commit()
+
+        messages = []
+        cursor = None
+        while True:
+            entries, cursor = Log.find_page(cursor=cursor, limit=2)
+            messages.extend(entry.message for entry in entries)
+            if cursor is None:
+                break
+        assert messages == ['test0', 'test1', 'test2', 'test3', 'test5', 'test4']
+
+        entries, cursor = Log.find_page(since=now - timedelta(hours=2), until=now, name='fireflash')
+        assert [entry.message for entry in entries] == ['test1', 'test2']
+        assert cursor is None
+
     def test_log_on_item_insert(self):
         item = Item('fireflash')
         db_session.add(item)
@@ -241,8 +476,67 @@ class MelangeLogTestCase(unittest.TestCase):
         db_session.commit()
 
         logs = Log.find_all()
+        assert len(logs) == 1
+        assert 'hello' in logs[0].message
+
+    def test_log_change_set(self):
+        item = Item('fireflash')
+        item.set_variable('hello', 'world')
+        item.set_variable('temp', 1)
+        laptop = Tag('laptop')
+        linux = Tag('linux')
+        item.add_to(laptop)
+        db_session.add(item)
+        db_session.add(linux)
+        db_session.commit()
+
+        item.set_variable('hello', 'again')
+        item.set_variable('new', [1, 2])
+        item.remove_variable('temp')
+        item.set_variable('gone', 1)
+        item.remove_variable('gone')
+        item.add_to(linux)
+        item.remove_from(laptop)
+        item.add_to(laptop)
+        item.save()
+
+        logs = Log.query.filter(Log.name=='fireflash').order_by(Log.id).all()
         assert len(logs) == 2
-        assert 'hello' in logs[0].message or 'hello' in logs[1].message
+        assert logs[0].message == 'Item created; Tags added: laptop; Variables added: hello, temp'
+        assert logs[1].get_changes() == {
+            'tags': {'added': ['linux'], 'removed': []},
+            'vars': {'added': {'new': [1, 2]}, 'changed': {'hello': 'again'}, 'removed': ['temp']},
+        }
+        assert logs[1].message == 'Tags added: linux; Variables added: new; Variables changed: hello; Variables removed: temp'
+
+class MelangeRetentionTestCase(unittest.TestCase):
+    def setUp(self):
+        melange.database.drop_db()
+        melange.database.init_db()
+        self.archive_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def test_archive_log(self):
+        now = datetime.utcnow()
+        for i in range(5):
+            db_session.add(Log('fireflash', 'old%d'%(i), now - timedelta(days=40, minutes=i)))
+            db_session.add(Log('firefly', 'older%d'%(i), now - timedelta(days=50, minutes=i)))
+        db_session.add(Log('fireflash', 'recent', now))
+        db_session.commit()
+
+        assert archive_log(self.archive_dir, 30, batch_size=3) == 10
+        assert [entry.message for entry in Log.find_all()] == ['recent']
+        assert os.path.exists(archive_path(self.archive_dir, (now - timedelta(days=40, minutes=4)).date()))
+        assert db_session.query(archived_log).count() >= 2
+
+        entries = list(iter_archived_log(self.archive_dir, name='fireflash'))
+        assert [entry['message'] for entry in entries] == ['old%d'%(i) for i in range(5)]
+        entries = list(iter_archived_log(self.archive_dir, until=now - timedelta(days=45)))
+        assert [entry['name'] for entry in entries] == ['firefly'] * 5
+
+        assert archive_log(self.archive_dir, 30) == 0
 
 if __name__ == '__main__':
     unittest.main()